@@ -33,7 +33,8 @@ from scriptcraft.gamemap import GameMap
 from scriptcraft.gamestate import (actions, Game, DEFAULT_GAME_CONFIGURATION,
                                    Language, Program, STAR_PROGRAM, Unit,
                                    NoFreeStartPosition, Tree, MineralDeposit,
-                                   load_game_map, InvalidGameMapData, cmds)
+                                   load_game_map, InvalidGameMapData, cmds,
+                                   RenderSnapshot)
 from scriptcraft.gamesession import (GameSession, SystemConfiguration,
                                      AlreadyExecuteGame)
 from scriptcraft.utils import *
@@ -41,9 +42,9 @@ from scriptcraft.utils import *
 
 
 class GameViewer(Canvas):
-    """GameViewer is canvas widget to display a scriptcraft Game
-    instance. It provides scrolling and zooming the map and selecting
-    fields.
+    """GameViewer is canvas widget to display a scriptcraft game (its
+    RenderSnapshot instance). It provides scrolling and zooming the map and
+    selecting fields.
 
     About selecting:
 
@@ -147,14 +148,20 @@ class GameViewer(Canvas):
         # own attributes
         self._zoom = 1.0
         self._delta = (-5.0, 0.0)
-        self._game = None
+        self._snapshot = None
         self._scaled_images_cache = {}
         self._ground_image_cache = None
         self._ground_tiles_cache = {}
         self._last_mouse_position = None # None unless button pressed
         self._click_position = None
         self.selection_position = None # None or (x, y)
-        self._trees_ids_by_position = {}
+        # self._drawn_objects is dict {key : [sprite name, position,
+        # sprite ID, label ID or None]} where key is ('tree', position),
+        # ('minerals', position) or ('unit', unit ID)
+        self._drawn_objects = {}
+        # dict {unit ID : (list of pairs (sprite name, position),
+        # list of IDs of items)} -- arrows and explosions
+        self._drawn_actions_by_IDs = {}
         self._queue = Queue()
         self._compute_ground_image_flag = False
 
@@ -214,25 +221,24 @@ class GameViewer(Canvas):
         self._check_queue()
 
     @log_on_enter('set game in game viewer', mode='only time')
-    def set_game(self, game):
-        """ Attribute game should be scriptcraft game instance or
+    def set_game(self, snapshot):
+        """ Attribute snapshot should be RenderSnapshot instance or
         None.
 
-        In this method game instance passed during previous
-        call is used. The previous game instance cannot be modified
-        since the previous call!
+        In this method snapshot passed during previous call is used
+        (snapshots are never modified).
 
-        Use set_game(None) and set_game(new_game) to force redrawing
+        Use set_game(None) and set_game(new_snapshot) to force redrawing
         ground and delete current selection.
         """
 
-        previous_game = self._game
-        self._game = game
+        previous_snapshot = self._snapshot
+        self._snapshot = snapshot
 
-        if previous_game:
+        if previous_snapshot:
             self.delete('non-cached')
 
-        if not game:
+        if not snapshot:
             # reset queue
             self._queue = Queue()
             self._compute_ground_image_flag = False
@@ -253,15 +259,18 @@ class GameViewer(Canvas):
             self.show_loading_indicator(False)
 
             # other stuff
-            self._trees_ids_by_position.clear()
-            self.delete('tree')
+            self._forget_drawn_game()
         else:
             # selection position
             self._set_selection_position(self.selection_position,
                                          force_emitting=True)
 
             # draw game
-            self._draw_game(game, old_game=previous_game)
+            if (previous_snapshot is not None and
+                previous_snapshot.size != snapshot.size):
+                self._forget_drawn_game()
+                previous_snapshot = None
+            self._draw_game(snapshot, old_snapshot=previous_snapshot)
 
     def set_corner_text(self, text):
         self.itemconfigure(self._corner_text_id,
@@ -349,141 +358,193 @@ class GameViewer(Canvas):
         self.master.after(GameViewer.FREQUENCY_OF_UPDATING_ANIMATIONS,
                           self._update_pointer_2)
 
-    def _draw_game(self, game, old_game):
+    def _draw_game(self, snapshot, old_snapshot):
+        """ Only changes since old_snapshot are drawn. Canvas items of
+        objects are reused -- they're moved or their images are changed. """
+
+        if old_snapshot is None:
+            self._draw_static_items(snapshot)
+
+        # find out what should be drawn
+        objs = ([(position, ('tree', position), 'tree%s' % tree_type, None)
+                 for position, tree_type in snapshot.trees] +
+                [(position, ('minerals', position),
+                  'minerals' if minerals else 'minerals-ex', None)
+                 for position, minerals in snapshot.mineral_deposits])
+        actions_by_IDs = {}
+        unit_positions_by_IDs = dict(zip(snapshot.unit_IDs,
+                                         snapshot.unit_positions))
+        for i, ID in enumerate(snapshot.unit_IDs):
+            position = snapshot.unit_positions[i]
+            label = snapshot.players[snapshot.unit_player_IDs[i]]
+            sprite_name = self._get_unit_sprite_name(
+                snapshot.unit_type_names[i],
+                snapshot.unit_directions[i],
+                snapshot.unit_minerals[i])
+            objs.append((position, ('unit', ID), sprite_name, label))
+            actions_by_IDs[ID] = self._get_action_sprites(
+                position, snapshot.unit_actions[i], unit_positions_by_IDs)
+        # objects are drawn diagonal by diagonal and row by row
+        objs.sort(key=lambda (pos, key, name, label): (pos[0]+pos[1], pos[1]))
+
+        # remove objects which disappeared
+        keys = set(key for _, key, _, _ in objs)
+        for key in self._drawn_objects.keys():
+            if key not in keys:
+                _, _, sprite_id, label_id = self._drawn_objects.pop(key)
+                self.delete(sprite_id)
+                if label_id is not None:
+                    self.delete(label_id)
+
+        # draw new objects and update changed ones
+        previous_top_id = None
+        for position, key, sprite_name, label in objs:
+            drawn = self._drawn_objects.get(key, None)
+            if drawn is None:
+                sprite_id = self._draw(sprite_name, position, layer=3,
+                                       cached=True, extra_tags=['object'])
+                label_id = (self._draw_label(label, position)
+                            if label is not None else None)
+                self._drawn_objects[key] = [sprite_name, position,
+                                            sprite_id, label_id]
+                restack = True
+            else:
+                old_sprite_name, old_position, sprite_id, label_id = drawn
+                if sprite_name != old_sprite_name:
+                    self.dtag(sprite_id, old_sprite_name)
+                    self.addtag_withtag(sprite_name, sprite_id)
+                    self.itemconfigure(
+                        sprite_id, image=self._get_scaled_sprite(sprite_name))
+                if (sprite_name != old_sprite_name or
+                    position != old_position):
+                    screen_position = self._to_screen_coordinate(position)
+                    self.coords(sprite_id, *self._to_image_position(
+                        sprite_name, screen_position))
+                    if label_id is not None:
+                        self.coords(label_id, *screen_position)
+                drawn[0], drawn[1] = sprite_name, position
+                restack = position != old_position
+
+            # keep drawing order of the objects
+            if restack:
+                if previous_top_id is None:
+                    self.tag_lower(sprite_id, 'layer-3')
+                else:
+                    self.tag_raise(sprite_id, previous_top_id)
+                if label_id is not None:
+                    self.tag_raise(label_id, sprite_id)
+            previous_top_id = label_id if label_id is not None else sprite_id
+
+        # draw arrows indicating executing actions (or fire explosions)
+        for ID in self._drawn_actions_by_IDs.keys():
+            if actions_by_IDs.get(ID, None) != \
+               self._drawn_actions_by_IDs[ID][0]:
+                _, ids = self._drawn_actions_by_IDs.pop(ID)
+                for id_ in ids:
+                    self.delete(id_)
+        for ID, sprites in actions_by_IDs.iteritems():
+            if sprites and ID not in self._drawn_actions_by_IDs:
+                ids = []
+                for sprite_name, position, layer in sprites:
+                    id_ = self._draw(sprite_name, position, layer=layer,
+                                     cached=True, extra_tags=['action'])
+                    if layer == 3:
+                        _, _, sprite_id, label_id = \
+                          self._drawn_objects[('unit', ID)]
+                        self.tag_raise(id_, label_id or sprite_id)
+                    ids.append(id_)
+                self._drawn_actions_by_IDs[ID] = (sprites, ids)
+
+        # sort layers
+        self._sort_layers()
+
+    def _draw_static_items(self, snapshot):
         # draw imitation of ground
-        size = self._game.game_map.size
+        size = snapshot.size
         points = [(0, 0), (0, size[1]), (size[0], size[1]), (size[0], 0)]
         points = [self._to_screen_coordinate(pos) for pos in points]
         points = [coord for pos in points for coord in pos]
         self.create_polygon(points,
                             fill=GameViewer.COLOR_OF_GROUND_IMITATION,
-                            tags=['game', 'non-cached', 'layer-1'])
+                            tags=['game', 'static', 'layer-1'])
 
         # draw ground
         self._draw_ground()
 
-        # remove deleted trees
-        tree_positions = [position for (position, obj)
-                          in self._game.game_map._objs.items()
-                          if isinstance(obj, Tree)]
-        tree_positions = set(tree_positions)
-
-        if old_game is not None:
-            old_tree_positions = [
-                position for (position, obj)
-                in old_game.game_map._objs.items()
-                if isinstance(obj, Tree)]
-            old_tree_positions = set(old_tree_positions)
-        else:
-            old_tree_positions = set()
-
-        deleted_trees = old_tree_positions - tree_positions
-        for position in deleted_trees:
-            self.delete(self._trees_ids_by_position[position])
-            del self._trees_ids_by_position[position]
-
-        # draw objects
-        def draw_arrow(source, destination, type='red'):
-            assert type in ('red', 'blue')
-            delta = map(lambda (a, b): a-b, zip(destination,
-                                                source))
-            d = direction.FROM_RAY[tuple(delta)]
-            direction_name = direction.TO_FULL_NAME[d]
-            self._draw('arrow-%s-%s' % (type, direction_name),
-                       source, layer=2)
-
-        objs = sorted(self._game.game_map._objs.items(),
-                      key=lambda (pos, obj): pos[0]+pos[1])
-        for position, obj in objs:
-            if isinstance(obj, Tree): # draw tree
-                if position not in old_tree_positions:
-                    name = 'tree%s' % obj.type
-                    id_ = self._draw(name, position, layer=3, cached=True,
-                                     extra_tags=['tree'])
-                    self._trees_ids_by_position[position] = id_
-                else:
-                    pass
-                    self.tag_raise(self._trees_ids_by_position[position])
-
-            elif isinstance(obj, MineralDeposit): # draw minerals
-                if obj.minerals:
-                    self._draw('minerals', position, layer=3)
-                else:
-                    self._draw('minerals-ex', position, layer=3)
-
-            elif isinstance(obj, Unit): # draw unit
-                unit = obj
-
-                # build sprite name
-                if unit.type.main_name == '4': # base
-                    sprite_name = 'base'
-                elif unit.type.main_name == '5': # miner
-                    storage_state = 'loaded' if unit.minerals else 'empty'
-                    direction_name = direction.TO_FULL_NAME[unit.direction]
-                    sprite_name = 'miner-%s-%s' % \
-                      (storage_state, direction_name)
-                elif unit.type.main_name == '6':
-                    direction_name = direction.TO_FULL_NAME[unit.direction]
-                    sprite_name = 'tank-%s' % direction_name
-                else:
-                    assert False, 'oops, unknown unit type %r' % unit.type
-
-                # draw the unit
-                self._draw(sprite_name, position, layer=3)
-
-                # draw label for the unit
-                x, y = self._to_screen_coordinate(position)
-                color = '#' + "%02x%02x%02x" % unit.player.color
-                font = self._get_font_for_current_zoom()
-                # this operation costs a lot [optimization]
-                self.create_text(x, y, fill=color, text=unit.player.name,
-                                 font=font, tags=['layer-3', 'game', 'text',
-                                                  'non-cached'],
-                                 state=NORMAL if font else HIDDEN)
-
-                # draw arrows indicating executing action (or fire explosion)
-                if isinstance(unit.action, actions.MoveAction):
-                    draw_arrow(unit.action.source,
-                               unit.action.destination,
-                               type='blue')
-                if isinstance(unit.action, actions.GatherAction):
-                    draw_arrow(unit.position,
-                               unit.action.source)
-                elif isinstance(unit.action, actions.StoreAction):
-                    destination_unit = self._game.units_by_IDs[
-                        unit.action.storage_ID]
-                    destination = destination_unit.position
-                    draw_arrow(unit.position, destination)
-                elif isinstance(unit.action, actions.FireAction):
-                    self._draw('explosion', unit.action.destination, layer=3)
-
         # draw lines (debug)
         def draw_grid():
             line_color = GameViewer.GRID_COLOR
 
-            for x in xrange(0, game.game_map.size[1] + 1):
+            for x in xrange(0, snapshot.size[1] + 1):
                 start_position = (0, x)
-                end_position = (game.game_map.size[0], x)
+                end_position = (snapshot.size[0], x)
                 start_position = self._to_screen_coordinate(start_position)
                 end_position = self._to_screen_coordinate(end_position)
                 self.create_line(*(start_position + end_position),
                                  fill=line_color,
-                                 tag=['layer-1.5', 'game', 'non-cached'])
+                                 tag=['layer-1.5', 'game', 'static'])
 
-            for y in xrange(0, game.game_map.size[0] + 1):
+            for y in xrange(0, snapshot.size[0] + 1):
                 start_position = (y, 0)
-                end_position = (y, game.game_map.size[1])
+                end_position = (y, snapshot.size[1])
                 start_position = self._to_screen_coordinate(start_position)
                 end_position = self._to_screen_coordinate(end_position)
                 self.create_line(*(start_position + end_position),
                                  fill=line_color,
-                                 tag=['layer-1.5', 'game', 'non-cached'])
+                                 tag=['layer-1.5', 'game', 'static'])
 
         # draw grid
         draw_grid()
 
-        # sort layers
-        self._sort_layers()
+    def _draw_label(self, (player_name, player_color), position):
+        x, y = self._to_screen_coordinate(position)
+        color = '#' + "%02x%02x%02x" % player_color
+        font = self._get_font_for_current_zoom()
+        # this operation costs a lot [optimization]
+        return self.create_text(x, y, fill=color, text=player_name,
+                                font=font, tags=['layer-3', 'game', 'text',
+                                                 'object'],
+                                state=NORMAL if font else HIDDEN)
+
+    def _forget_drawn_game(self):
+        self._drawn_objects.clear()
+        self._drawn_actions_by_IDs.clear()
+        self.delete('object', 'action', 'static', 'ground')
+
+    def _get_unit_sprite_name(self, type_name, unit_direction, minerals):
+        if type_name == '4': # base
+            return 'base'
+        elif type_name == '5': # miner
+            storage_state = 'loaded' if minerals else 'empty'
+            direction_name = direction.TO_FULL_NAME[unit_direction]
+            return 'miner-%s-%s' % (storage_state, direction_name)
+        elif type_name == '6':
+            direction_name = direction.TO_FULL_NAME[unit_direction]
+            return 'tank-%s' % direction_name
+        else:
+            assert False, 'oops, unknown unit type %r' % type_name
+
+    def _get_action_sprites(self, position, action, unit_positions_by_IDs):
+        """ Return list of triples (sprite name, position, layer). """
+
+        def arrow(source, destination, type='red'):
+            assert type in ('red', 'blue')
+            delta = map(lambda (a, b): a-b, zip(destination,
+                                                source))
+            d = direction.FROM_RAY[tuple(delta)]
+            direction_name = direction.TO_FULL_NAME[d]
+            return ('arrow-%s-%s' % (type, direction_name), source, 2)
+
+        if isinstance(action, actions.MoveAction):
+            return [arrow(action.source, action.destination, type='blue')]
+        elif isinstance(action, actions.GatherAction):
+            return [arrow(position, action.source)]
+        elif isinstance(action, actions.StoreAction):
+            destination = unit_positions_by_IDs[action.storage_ID]
+            return [arrow(position, destination)]
+        elif isinstance(action, actions.FireAction):
+            return [('explosion', action.destination, 3)]
+        return []
 
     def _sort_layers(self):
         self.tag_raise('layer-1')
@@ -495,7 +556,7 @@ class GameViewer(Canvas):
 
     def _draw_ground(self):
         if self._ground_image_cache:
-            self._draw('ground', (0, 0), layer=1)
+            self._draw('ground', (0, 0), layer=1, cached=True)
             self.tag_lower('layer-1')
         elif not self._compute_ground_image_flag:
             target = lambda: self._compute_ground_image_asynch(self._queue)
@@ -606,19 +667,19 @@ class GameViewer(Canvas):
             gradient_ns = self._gradient('ns')
             gradient_we = self._gradient('we')
 
-            size = self._game.game_map.size
+            snapshot = self._snapshot
+            size = snapshot.size
             image_size = (GameViewer.TILE_WIDTH/2.0*(size[0]+size[1]+2),
                           GameViewer.TILE_HEIGHT/2.0*(size[0]+size[1]+2))
             result = Image.new('RGB', map(int, image_size))
-            game_map = self._game.game_map
 
             for (x, y) in itertools.product(xrange(-1, size[0]),
                                             xrange(-1, size[1])):
 
-                ground_type_nw = game_map[x, y].ground_type or 0
-                ground_type_ne = game_map[x+1, y].ground_type or 0
-                ground_type_se = game_map[x+1, y+1].ground_type or 0
-                ground_type_sw = game_map[x, y+1].ground_type or 0
+                ground_type_nw = snapshot.ground_type_at(x, y)
+                ground_type_ne = snapshot.ground_type_at(x+1, y)
+                ground_type_se = snapshot.ground_type_at(x+1, y+1)
+                ground_type_sw = snapshot.ground_type_at(x, y+1)
 
                 tile_name_nw = GameViewer.GROUND_TYPE_TO_NAME[ground_type_nw]
                 tile_name_ne = GameViewer.GROUND_TYPE_TO_NAME[ground_type_ne]
@@ -689,7 +750,7 @@ class GameViewer(Canvas):
     def _to_image_position(self, image_name, (x, y)):
         """ From screen coordinaties. """
         if image_name == 'ground':
-            dx = GameViewer.TILE_WIDTH/2.0 * (self._game.game_map.size[1]+1)
+            dx = GameViewer.TILE_WIDTH/2.0 * (self._snapshot.size[1]+1)
             dy = GameViewer.TILE_HEIGHT/2.0
         else:
             switch = {
@@ -757,13 +818,13 @@ class GameViewer(Canvas):
                   -delta_delta[1]*32.0*self._zoom)
 
     def _clear_delta(self, delta):
-        if not self._game:
+        if not self._snapshot:
             return delta
 
         size = self.winfo_width(), self.winfo_height()
         center_of_screen = (size[0]/2, size[1]/2)
-        map_width = self._game.game_map.size[0]
-        map_height = self._game.game_map.size[1]
+        map_width = self._snapshot.size[0]
+        map_height = self._snapshot.size[1]
         pos = self._to_game_coordinate(center_of_screen, delta=delta)
         if (0 <= pos[0] < map_width and
             0 <= pos[1] < map_height):
@@ -786,7 +847,7 @@ class GameViewer(Canvas):
             self.event_generate('<<selection-changed>>')
 
     def _roll_wheel_callback(self, event):
-        if self._game:
+        if self._snapshot:
             delta = 0
             if event.num == 5: # respond Linux wheel event
                 delta -= 1
@@ -801,7 +862,7 @@ class GameViewer(Canvas):
     def _mouse_motion_with_button_pressed_callback(self, event):
         # scrolling map
 
-        if self._game and self._last_mouse_position:
+        if self._snapshot and self._last_mouse_position:
             with log_on_enter('moving everything', mode='only time'):
                 dx, dy = (event.x - self._last_mouse_position[0],
                           event.y - self._last_mouse_position[1])
@@ -816,23 +877,23 @@ class GameViewer(Canvas):
         self._last_mouse_position = (event.x, event.y)
 
     def _mouse_motion_callback(self, event):
-        if not self._game:
+        if not self._snapshot:
             return
 
         # info about field/unit under mouse -- update corner text
         pos = self._to_game_coordinate((event.x, event.y))
         pos = tuple(map(lambda x: int(math.floor(x)), pos))
-        if self._game.game_map[pos].valid_position:
+        if self._snapshot.is_valid_position(pos):
             self._set_selection_position(pos)
         else:
             self._set_selection_position(None)
 
     def _click_callback(self, event):
-        if self._game:
+        if self._snapshot:
             self._click_position = (event.x, event.y)
 
     def _double_click_callback(self, event):
-        if self._game:
+        if self._snapshot:
             self.event_generate('<<field-double-clicked>>')
 
     def _release_callback(self, event):
@@ -844,7 +905,7 @@ class GameViewer(Canvas):
                 self._single_click_callback(event)
 
     def _single_click_callback(self, event):
-        if self._game:
+        if self._snapshot:
             click_position = self._to_game_coordinate((event.x, event.y))
             integer_click_position = map(lambda i: int(math.floor(i)),
                                          click_position)
@@ -1082,7 +1143,8 @@ class UnitInfoWindow(tkSimpleDialog.Dialog):
             scroll, height=1, width=1,
             font=tkFont.Font(**UnitInfoWindow.FONT_ATTRS))
         text = (self._maybe_run_status.input
-                if self._maybe_run_status
+                if self._maybe_run_status and
+                   self._maybe_run_status.input is not None
                 else "")
         self._execution_input_area.insert('1.0', text)
         self._execution_input_area.configure(state=DISABLED)
@@ -1277,7 +1339,7 @@ class ClientApplication(Frame):
         def set_program(unit_id, filename):
             program = Program(Language.PYTHON,
                               open('scriptcraft/.tmp/'+filename).read())
-            game.set_program(game.units_by_IDs[unit_id], program)
+            session.set_program(game.units_by_IDs[unit_id], program)
         try:
             set_program(8, 'build_tank.py')
             for i in xrange(3,7):
@@ -1293,7 +1355,8 @@ class ClientApplication(Frame):
         if not self._queue.empty():
             command = self._queue.get_nowait()
             assert command == 'ready'
-            self._set_game(self._game_session.game)
+            self._set_game(self._game_session.game,
+                           self._game_session.render_snapshot)
             if self._tic_in_loop.get():
                 self.master.after(ClientApplication.TIME_BETWEEN_TICS,
                                   self._tic)
@@ -1638,6 +1701,7 @@ class ClientApplication(Frame):
         if not self._ask_if_quit_program():
             return
 
+        self.set_game_session(None)
         global root
         root.destroy()
 
@@ -1843,16 +1907,20 @@ class ClientApplication(Frame):
 
     @log_on_enter('set game session')
     def set_game_session(self, game_session):
+        if self._game_session is not None:
+            self._game_session.close()
         self._game_session = game_session
         self._set_game(None)
         self._tic_in_loop.set(False)
         self._queue = Queue()
         if game_session:
-            self._set_game(game_session.game)
+            self._set_game(game_session.game,
+                           game_session.render_snapshot)
 
-    def _set_game(self, game):
+    def _set_game(self, game, snapshot=None):
         """ Call it if game instance was changed and you want to make
-        the application up to date."""
+        the application up to date. If snapshot of the game isn't given,
+        it's built."""
 
         # set game.free_colors
         if game is not None and not hasattr(game, 'free_colors'):
@@ -1871,7 +1939,9 @@ class ClientApplication(Frame):
 
         # other stuff
         self._game = game
-        self._game_viewer.set_game(game)
+        if game is not None and snapshot is None:
+            snapshot = RenderSnapshot(game)
+        self._game_viewer.set_game(snapshot)
         self._refresh_game_menu_items_state()
 
     def _reserve_color(self):
@@ -1,11 +1,23 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import errno
 import hashlib
+from multiprocessing.pool import ThreadPool
 import os
+try:
+    import cPickle as pickle
+except:
+    import pickle
+import shlex
 import shutil
+import select
 import stat
 import subprocess
+import thread
+import threading
 import time
 
 from scriptcraft.utils import *
@@ -13,13 +25,53 @@ from scriptcraft.utils import *
 
 
 class CompileAndRunProgram(object):
+    """ Compile (if it wasn't compiled before) and run a program.
+
+    Instances may be called concurrently from many threads. Each call uses
+    its own sandbox (a working directory) from a pool of sandboxes, and
+    compiled programs are stored in shared 'cache' folder (see
+    CompileCache). A program with the same sha is never compiled by two
+    calls at the same time. """
+
+    reentrant = True
+    DETERMINISTIC_PROGRAM_MARKER = 'scriptcraft: deterministic'
+    BATCH_PROGRAM_MARKER = 'scriptcraft: batch'
+    # number of times a program in batch mode is executed again after it
+    # was killed or finished before writing all records
+    MAX_BATCH_RESTARTS = 2
+    # number of remembered statuses of compilations done in background
+    # which weren't returned yet
+    MAX_PENDING_COMPILATION_STATUSES = 1024
+
     def __init__(self, directory,
                  source_file_names_by_languages,
                  binary_file_names_by_languages,
                  compilation_commands_by_languages,
                  running_commands_by_languages,
                  max_compilation_time=None,
-                 max_execution_time=None):
+                 max_execution_time=None,
+                 warm_worker_pools_by_languages=None,
+                 max_output_size=None,
+                 max_memoized_outputs=0,
+                 max_cache_size=None,
+                 max_background_compilations=1):
+        """ Programs in languages from warm_worker_pools_by_languages
+        dict are not executed by running command but by a worker from
+        the pool (i. e. PythonWorkerPool).
+
+        A program is killed if its output (stdout and stderr) is longer
+        than max_output_size bytes.
+
+        Running statuses of at most max_memoized_outputs deterministic
+        programs are remembered (0 means that outputs are never
+        memoized).
+
+        Compiled programs are removed from the cache if their total size
+        exceeds max_cache_size bytes.
+
+        At most max_background_compilations programs are compiled in
+        background at the same time. """
+
         self._directory = directory
         self._source_file_names_by_languages = source_file_names_by_languages
         self._binary_file_names_by_languages = binary_file_names_by_languages
@@ -27,95 +79,897 @@ class CompileAndRunProgram(object):
         self._running_commands_by_languages = running_commands_by_languages
         self._max_compilation_time = max_compilation_time
         self._max_execution_time = max_execution_time
+        self._max_output_size = max_output_size
+        self._run_results = None
+        if max_memoized_outputs > 0:
+            self._run_results = _RunResultCache(max_memoized_outputs)
         self._env = Environment(directory)
+        self._compile_cache = CompileCache(self._env, 'cache', max_cache_size)
+        self._sandboxes = SandboxPool(self._env, 'env')
+        self._compilation_locks = _LocksByKeys()
+        # pool of threads compiling programs in background (created on
+        # demand), shas of programs waiting for them or being compiled and
+        # statuses of compilations done in background by sha (the oldest
+        # first); all of them are guarded by self._background_lock
+        self._max_background_compilations = max_background_compilations
+        self._background_pool = None
+        self._background_shas = set()
+        self._pending_compilation_statuses = OrderedDict()
+        self._background_lock = threading.Lock()
+        self._warm_worker_pools_by_languages = \
+            warm_worker_pools_by_languages or {}
+        self._running_argv_templates_by_languages = dict(
+            (language, _running_argv_template(
+                command,
+                binary_file_names_by_languages[language],
+                source_file_names_by_languages[language]))
+            for language, command in running_commands_by_languages.items())
 
     @log_on_enter('compile and run program', mode='only time')
     def __call__(self, language, program_code, input_data,
-                 max_compilation_time=None, max_execution_time=None):
-        self._language = language
-        self._program_code = program_code
-        self._input_data = input_data
-        self._sha = self._get_program_hash(language, program_code)
-        self._compilation_command = self._compilation_commands_by_languages[language]
-        self._running_command = self._running_commands_by_languages[language]
-        self._source_file_name = self._source_file_names_by_languages[language]
-        self._binary_file_name = self._binary_file_names_by_languages[language]
-
-        compilation_status = self._compile()
-        running_status = self._run()
+                 max_compilation_time=None, max_execution_time=None,
+                 deterministic=False):
+        """ If the program is deterministic (deterministic is True or the
+        program contains DETERMINISTIC_PROGRAM_MARKER), it may be not
+        executed at all -- its memoized running status for the same input
+        is returned then. Programs supporting batch mode get the input as
+        a single record. """
+
+        if self.supports_batch(language, program_code):
+            compilation_status, running_statuses = \
+                self.run_many(language, program_code, [input_data],
+                              deterministic)
+            return (compilation_status, running_statuses[0])
+
+        job = self._build_job(language, program_code, input_data)
+        key = self._get_memoization_key(job, input_data, deterministic)
+        if key is not None:
+            running_status = self._run_results.get(key)
+            if running_status is not None:
+                return (None, running_status)
+
+        with self._sandboxes.sandbox() as sandbox, \
+             self._compile_cache.binary_in_use(job.sha):
+            compilation_status = self._compile(job, sandbox)
+            running_status = self._run(job, sandbox)
+
+        self._memoize(key, running_status)
         return (compilation_status, running_status)
 
+    def compile_in_background(self, language, program_code):
+        """ Queue compilation of the program in background unless the
+        program is in the cache or it's already queued. The compilation
+        status is returned by the first call for the program, which waits
+        for the compilation if it's still in progress. """
+
+        job = self._build_job(language, program_code, '')
+        if self._compile_cache.contains(job.sha):
+            return
+        with self._background_lock:
+            if job.sha in self._background_shas:
+                return
+            self._background_shas.add(job.sha)
+            if self._background_pool is None:
+                self._background_pool = \
+                    ThreadPool(self._max_background_compilations)
+            self._background_pool.apply_async(self._compile_in_background,
+                                              (job,))
+
+    def supports_batch(self, language, program_code):
+        """ Programs containing BATCH_PROGRAM_MARKER handle many inputs
+        in one execution. Such a program reads records from stdin until
+        EOF and writes one record to stdout for every input record. A
+        record is its length in bytes (in decimal) and new line character
+        followed by data. """
+
+        return (language not in self._warm_worker_pools_by_languages and
+                CompileAndRunProgram.BATCH_PROGRAM_MARKER in program_code)
+
+    @log_on_enter('compile and run program for many inputs', mode='only time')
+    def run_many(self, language, program_code, inputs, deterministic=False):
+        """ Like calling the instance for every input, but a program
+        supporting batch mode is executed once for all inputs. Every
+        record has its own time limit. If the program is killed or
+        finishes before writing all records, the record being processed
+        gets empty output and the program is executed again for the rest
+        of inputs, but at most MAX_BATCH_RESTARTS times -- then the rest of
+        inputs get empty outputs and are marked as killed. Return tuple
+        (compilation_status, running_statuses). Every running status
+        contains the whole stderr of the execution. """
+
+        if not self.supports_batch(language, program_code):
+            statuses = [self(language, program_code, input_data,
+                             deterministic=deterministic)
+                        for input_data in inputs]
+            compilation_statuses = [compilation_status
+                                    for compilation_status, _ in statuses
+                                    if compilation_status is not None]
+            compilation_status = (compilation_statuses[0]
+                                  if compilation_statuses else None)
+            return (compilation_status,
+                    [running_status for _, running_status in statuses])
+
+        job = self._build_job(language, program_code, '')
+        keys = [self._get_memoization_key(job, input_data, deterministic)
+                for input_data in inputs]
+        running_statuses = [self._run_results.get(key)
+                            if key is not None else None
+                            for key in keys]
+        missing = [i for i, running_status in enumerate(running_statuses)
+                   if running_status is None]
+        if not missing:
+            return (None, running_statuses)
+
+        with self._sandboxes.sandbox() as sandbox, \
+             self._compile_cache.binary_in_use(job.sha):
+            compilation_status = self._compile(job, sandbox)
+            missing_statuses = self._run_batch(
+                job, sandbox, [inputs[i] for i in missing])
+
+        for i, running_status in zip(missing, missing_statuses):
+            running_statuses[i] = running_status
+            self._memoize(keys[i], running_status)
+        return (compilation_status, running_statuses)
+
+    def close(self):
+        """ Stop all warm workers and background compilations and save
+        index of the compile cache. """
+        for pool in self._warm_worker_pools_by_languages.itervalues():
+            pool.close()
+        with self._background_lock:
+            background_pool, self._background_pool = \
+                self._background_pool, None
+        if background_pool is not None:
+            background_pool.terminate()
+        try:
+            self._compile_cache.save()
+        except (OSError, IOError):
+            log_exception('unable to save index of compile cache')
+
+    @property
+    def compile_cache(self):
+        return self._compile_cache
+
+    def _build_job(self, language, program_code, input_data):
+        return _Job(
+            language=language,
+            program_code=program_code,
+            input_data=input_data,
+            sha=self._get_program_hash(language, program_code),
+            compilation_command=self._compilation_commands_by_languages[language],
+            running_command=self._running_commands_by_languages[language],
+            source_file_name=self._source_file_names_by_languages[language],
+            binary_file_name=self._binary_file_names_by_languages[language])
+
+    def _get_memoization_key(self, job, input_data, deterministic):
+        if self._run_results is None:
+            return None
+        if not (deterministic or CompileAndRunProgram. \
+                DETERMINISTIC_PROGRAM_MARKER in job.program_code):
+            return None
+        return (job.language, job.sha,
+                hashlib.sha1(input_data.encode('utf8')).hexdigest())
+
+    def _memoize(self, key, running_status):
+        if key is None or running_status is None:
+            return
+        output, error_output, killed, execution_time = running_status
+        if not killed:
+            self._run_results.put(key, running_status)
+
     def _get_program_hash(self, language, program_code):
         hasher = hashlib.sha1()
         hasher.update(language)
         hasher.update(program_code.encode('utf8'))
         return hasher.hexdigest()
 
+    @log_on_enter('compile program in background', mode='only time')
+    def _compile_in_background(self, job):
+        try:
+            with self._sandboxes.sandbox() as sandbox:
+                self._compile(job, sandbox, in_background=True)
+        finally:
+            with self._background_lock:
+                self._background_shas.discard(job.sha)
+
     @on_error_return((OSError, IOError), None)
-    def _compile(self):
-        if not self._is_compilation_necessary():
-            return None
-        self._clear_environment()
-        self._create_source_file()
-        compilation_status = self._execute_compilation_command()
-        self._copy_binary_if_exists()
-        return compilation_status
+    def _compile(self, job, sandbox, in_background=False):
+        with self._compilation_locks[job.sha]:
+            pending_status = None
+            if not in_background:
+                with self._background_lock:
+                    pending_status = \
+                        self._pending_compilation_statuses.pop(job.sha, None)
+            entry = self._compile_cache.lookup(job.sha)
+            if entry is not None:
+                if pending_status is not None:
+                    return pending_status
+                # None or the status of failed compilation
+                return entry.compilation_status
+            self._sandboxes.clear(sandbox)
+            self._create_source_file(job, sandbox)
+            compilation_status = self._execute_compilation_command(job, sandbox)
+            self._store_compilation_result(job, sandbox, compilation_status)
+            if in_background:
+                self._remember_pending_compilation_status(job.sha,
+                                                          compilation_status)
+            return compilation_status
+
+    def _remember_pending_compilation_status(self, sha, compilation_status):
+        """ Statuses of programs which are never executed (i. e. they
+        were replaced) are forgotten when there are too many of them. """
 
-    def _is_compilation_necessary(self):
-        binary = ('cache', self._sha)
-        return not self._env.exists_file(binary)
+        with self._background_lock:
+            statuses = self._pending_compilation_statuses
+            statuses[sha] = compilation_status
+            while (len(statuses) >
+                   CompileAndRunProgram.MAX_PENDING_COMPILATION_STATUSES):
+                statuses.popitem(last=False)
 
-    def _create_source_file(self):
-        self._env.create_file(('env', self._source_file_name),
-                              self._program_code)
+    def _create_source_file(self, job, sandbox):
+        self._env.create_file(sandbox + (job.source_file_name,),
+                              job.program_code)
 
     @log_on_enter('execute compilation command', mode='only time')
-    def _execute_compilation_command(self):
+    def _execute_compilation_command(self, job, sandbox):
         input = ''
-        directory = 'env'
         output, error_output, exit_status, killed, execution_time = \
-            self._env.execute_bash_command(self._compilation_command,
-                                           input, directory,
+            self._env.execute_bash_command(job.compilation_command,
+                                           input, sandbox,
                                            self._max_compilation_time)
         return (output, error_output, killed, execution_time)
 
-    def _copy_binary_if_exists(self):
-        source = ('env', self._binary_file_name)
-        destination = ('cache', self._sha)
+    def _store_compilation_result(self, job, sandbox, compilation_status):
+        source = sandbox + (job.binary_file_name,)
+        output, error_output, killed, execution_time = compilation_status
         if self._env.exists_file(source):
-            self._env.copy_file(source, destination)
-
-    def _clear_environment(self):
-        self._env.remove_folder_recursively('env')
+            self._compile_cache.put_binary(job.sha, source)
+        elif not killed: # compilation may succeed next time
+            self._compile_cache.put_failure(job.sha, compilation_status)
 
     @on_error_return((OSError, IOError), None)
-    def _run(self):
-        if not self._is_compilation_successful():
+    def _run(self, job, sandbox):
+        if not self._is_compilation_successful(job):
             return None
-        self._clear_environment()
-        self._copy_binary()
-        self._create_source_file()
-        running_status = self._execute_run_command()
-        return running_status
-
-    def _is_compilation_successful(self):
-        return self._env.exists_file(('cache', self._sha))
-
-    def _copy_binary(self):
-        source = ('cache', self._sha)
-        destination = ('env', self._binary_file_name)
+        pool = self._warm_worker_pools_by_languages.get(job.language, None)
+        if pool is not None:
+            return self._execute_in_warm_worker(job, pool)
+        return self._execute_program(job, sandbox)
+
+    def _run_batch(self, job, sandbox, inputs):
+        if not self._is_compilation_successful(job):
+            return [None] * len(inputs)
+        running_statuses = []
+        restarts = 0
+        # Every execution processes at least one record, because the
+        # record processed when the program was killed or finished is
+        # skipped.
+        while len(running_statuses) < len(inputs):
+            remaining_inputs = inputs[len(running_statuses):]
+            if restarts > CompileAndRunProgram.MAX_BATCH_RESTARTS:
+                running_statuses.extend([(u'', error_output, True, 0.0)
+                                         for _ in remaining_inputs])
+                break
+            result = self._execute_batch(job, sandbox, remaining_inputs)
+            if result is None:
+                running_statuses.extend([None] * len(remaining_inputs))
+                break
+            reader, (output, error_output, killed, execution_time) = result
+            records = zip(reader.records,
+                          reader.execution_times)[:len(remaining_inputs)]
+            running_statuses.extend(
+                [(_decoded_output(record), error_output,
+                  False, record_execution_time)
+                 for record, record_execution_time in records])
+            if len(records) < len(remaining_inputs):
+                running_statuses.append((u'', error_output, killed,
+                                         reader.time_since_last_record()))
+                restarts += 1
+        return running_statuses
+
+    @on_error_return((OSError, IOError), None)
+    def _execute_batch(self, job, sandbox, inputs):
+        encoded_inputs = [input_data.encode('utf8') for input_data in inputs]
+        batch_job = job._replace(input_data=''.join(
+            '%d\n%s' % (len(input_data), input_data)
+            for input_data in encoded_inputs))
+        reader = _BatchOutputReader(self._max_execution_time)
+        max_output_size = None
+        if self._max_output_size is not None:
+            max_output_size = self._max_output_size * len(inputs)
+        running_status = self._execute_program(batch_job, sandbox,
+                                               max_output_size, reader.feed)
+        return reader, running_status
+
+    def _execute_program(self, job, sandbox, max_output_size=None,
+                         on_output=None):
+        if max_output_size is None:
+            max_output_size = self._max_output_size
+        template = self._running_argv_templates_by_languages[job.language]
+        if template is not None:
+            return self._execute_cached_binary(job, sandbox, template,
+                                               max_output_size, on_output)
+        self._sandboxes.clear(sandbox)
+        self._copy_binary(job, sandbox)
+        self._create_source_file(job, sandbox)
+        return self._execute_run_command(job, sandbox, max_output_size,
+                                         on_output)
+
+    def _is_compilation_successful(self, job):
+        return self._compile_cache.is_compiled(job.sha)
+
+    def _copy_binary(self, job, sandbox):
+        source = self._compile_cache.binary_path(job.sha)
+        destination = sandbox + (job.binary_file_name,)
         self._env.copy_file(source, destination)
 
     @log_on_enter('execute running command', mode='only time')
-    def _execute_run_command(self):
-        input = self._input_data
-        folder = 'env'
+    def _execute_run_command(self, job, sandbox, max_output_size, on_output):
         output, error_output, exit_code, killed, execution_time = \
-            self._env.execute_bash_command(self._running_command,
-                                           input, folder,
-                                           self._max_execution_time)
+            self._env.execute_bash_command(job.running_command,
+                                           job.input_data, sandbox,
+                                           self._max_execution_time,
+                                           max_output_size, on_output)
         return (output, error_output, killed, execution_time)
 
+    @log_on_enter('execute cached binary', mode='only time')
+    def _execute_cached_binary(self, job, sandbox, template,
+                               max_output_size, on_output):
+        """ Run the binary from the cache without copying it to the
+        sandbox and without shell. """
+
+        self._sandboxes.prepare(sandbox)
+        binary = self._env.absolute_path(
+            self._compile_cache.binary_path(job.sha))
+        argv = [binary if token is None else token for token in template]
+        output, error_output, exit_code, killed, execution_time = \
+            self._env.execute_command(argv, job.input_data, sandbox,
+                                      self._max_execution_time,
+                                      max_output_size, on_output)
+        return (output, error_output, killed, execution_time)
+
+    @log_on_enter('execute in warm worker', mode='only time')
+    def _execute_in_warm_worker(self, job, pool):
+        binary = self._env.absolute_path(
+            self._compile_cache.binary_path(job.sha))
+        output, error_output, killed, execution_time = \
+            pool.run(binary, job.input_data, self._max_execution_time)
+        # Workers collect whole output, so the limit is checked afterwards.
+        if (self._max_output_size is not None and
+            len(output) + len(error_output) > self._max_output_size):
+            output, error_output, killed = u'', u'', True
+        return (output, error_output, killed, execution_time)
+
+
+_Job = namedtuple('_Job', ('language',
+                           'program_code',
+                           'input_data',
+                           'sha',
+                           'compilation_command',
+                           'running_command',
+                           'source_file_name',
+                           'binary_file_name'))
+
+
+class _LocksByKeys(object):
+    """ Dictionary-like object creating a lock for each key on demand. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks_by_keys = {}
+
+    def __getitem__(self, key):
+        with self._lock:
+            lock = self._locks_by_keys.get(key, None)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks_by_keys[key] = lock
+            return lock
+
+
+class _CacheEntry(namedtuple('_CacheEntry', ('size', 'compilation_status'))):
+    """ compilation_status is None for compiled programs and the status
+    of failed compilation otherwise. """
+
+    __slots__ = ()
+
+    @property
+    def failed(self):
+        return self.compilation_status is not None
+
+
+class CompileCache(object):
+    """ Compiled programs stored in a folder of an Environment, one file
+    per program sha. The in-memory index remembers which programs were
+    compiled, which ones failed to compile (together with the status of
+    the compilation) and the order in which they were used, so cache hits
+    don't touch the file system. The index is
+    saved in INDEX_FILE_NAME file in the folder and loaded at startup.
+
+    The least recently used binaries are removed when their total size
+    exceeds max_size bytes (None means no limit), except binaries in use
+    (see binary_in_use). At most MAX_FAILURES failed compilations are
+    remembered.
+
+    All methods may be called concurrently. Methods which change the cache
+    may raise OSError or IOError. """
+
+    INDEX_FILE_NAME = 'index'
+    MAX_FAILURES = 1024
+    PICKLE_PROTOCOL = 2
+
+    def __init__(self, env, folder, max_size=None):
+        self._env = env
+        self._folder = folder
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._saving_lock = threading.Lock()
+        self._entries = OrderedDict() # the least recently used first
+        self._total_size = 0
+        # dict {sha : number of users} of binaries which cannot be removed
+        self._users_by_shas = {}
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def lookup(self, sha):
+        """ Return entry with attributes 'size', 'compilation_status'
+        (None if the program was compiled) and 'failed' or None if the
+        program is not in the cache. Counted as a hit or a miss. """
+
+        with self._lock:
+            entry = self._entries.pop(sha, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[sha] = entry # move to the end
+            self.hits += 1
+            return entry
+
+    def contains(self, sha):
+        """ Unlike lookup, it's not counted as a hit or a miss and it
+        doesn't change the order of entries. """
+        with self._lock:
+            return sha in self._entries
+
+    def is_compiled(self, sha):
+        with self._lock:
+            entry = self._entries.get(sha, None)
+            return entry is not None and not entry.failed
+
+    def binary_path(self, sha):
+        return (self._folder, sha)
+
+    @contextmanager
+    def binary_in_use(self, sha):
+        """ The binary (even if it's not compiled yet) is not removed
+        from the cache inside the context, so it may be copied or
+        executed. """
+
+        with self._lock:
+            self._users_by_shas[sha] = self._users_by_shas.get(sha, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._users_by_shas[sha] -= 1
+                if not self._users_by_shas[sha]:
+                    del self._users_by_shas[sha]
+
+    def put_binary(self, sha, source_path):
+        path = self.binary_path(sha)
+        if self._env.exists_file(path): # not in the index
+            self._env.remove_file(path)
+        self._env.copy_file_atomically(source_path, path)
+        size = self._env.file_size(path)
+        with self._lock:
+            self._put_entry(sha, _CacheEntry(size=size,
+                                             compilation_status=None))
+            evicted = self._evict(protected_sha=sha)
+        for evicted_sha in evicted:
+            self._env.remove_file(self.binary_path(evicted_sha))
+        self.save()
+
+    def put_failure(self, sha, compilation_status):
+        with self._lock:
+            self._put_entry(sha, _CacheEntry(
+                size=0, compilation_status=tuple(compilation_status)))
+            self._evict(protected_sha=sha)
+        self.save()
+
+    def statistics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            failures = sum(1 for entry in self._entries.itervalues()
+                           if entry.failed)
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_ratio' : float(self.hits)/lookups if lookups else 0.0,
+                'binaries' : len(self._entries) - failures,
+                'failures' : failures,
+                'size' : self._total_size,
+            }
+
+    def save(self):
+        with self._lock:
+            index = [(sha, entry.size, entry.compilation_status)
+                     for sha, entry in self._entries.iteritems()]
+        data = pickle.dumps(index, CompileCache.PICKLE_PROTOCOL)
+        with self._saving_lock:
+            self._env.write_file_atomically(
+                (self._folder, CompileCache.INDEX_FILE_NAME), data)
+
+    def _put_entry(self, sha, entry):
+        old_entry = self._entries.pop(sha, None)
+        if old_entry is not None:
+            self._total_size -= old_entry.size
+        self._entries[sha] = entry
+        self._total_size += entry.size
+
+    def _evict(self, protected_sha):
+        evicted = []
+        if self._max_size is not None:
+            for sha, entry in self._entries.items():
+                if self._total_size <= self._max_size:
+                    break
+                if (sha != protected_sha and not entry.failed and
+                    sha not in self._users_by_shas):
+                    del self._entries[sha]
+                    self._total_size -= entry.size
+                    evicted.append(sha)
+        failures = [sha for sha, entry in self._entries.iteritems()
+                    if entry.failed]
+        for sha in failures[:max(len(failures) - CompileCache.MAX_FAILURES,
+                                 0)]:
+            del self._entries[sha]
+        return evicted
+
+    def _load(self):
+        try:
+            names = set(self._env.list_folder(self._folder))
+        except OSError:
+            names = set() # the folder doesn't exist
+        try:
+            data = self._env.read_file((self._folder,
+                                        CompileCache.INDEX_FILE_NAME))
+            index = pickle.loads(data)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            index = [] # missing or broken index
+
+        # binaries without index entries (i. e. compiled by an older
+        # version) are treated as the least recently used ones
+        indexed = set(sha for sha, size, compilation_status in index)
+        for name in sorted(names - indexed):
+            if _is_sha(name):
+                size = self._env.file_size((self._folder, name))
+                self._put_entry(name, _CacheEntry(size=size,
+                                                  compilation_status=None))
+        for sha, size, compilation_status in index:
+            if compilation_status is not None or sha in names:
+                self._put_entry(sha, _CacheEntry(size, compilation_status))
+
+
+def _is_sha(name):
+    return len(name) == 40 and all(char in '0123456789abcdef'
+                                   for char in name)
+
+
+class _BatchOutputReader(object):
+    """ Split output of a program executed in batch mode into records.
+    feed returns deadline for the next record. """
+
+    def __init__(self, max_time_per_record):
+        self.records = []
+        self.execution_times = []
+        self._max_time_per_record = max_time_per_record
+        self._buffer = ''
+        self._malformed = False
+        self._last_record_time = time.time()
+
+    def feed(self, data):
+        if self._malformed:
+            return None
+        self._buffer += data
+        while True:
+            header_end = self._buffer.find('\n')
+            if header_end == -1:
+                break
+            try:
+                length = int(self._buffer[:header_end])
+            except ValueError:
+                self._malformed = True
+                return None
+            record_end = header_end + 1 + length
+            if len(self._buffer) < record_end:
+                break
+            self.records.append(self._buffer[header_end+1:record_end])
+            self._buffer = self._buffer[record_end:]
+            now = time.time()
+            self.execution_times.append(now - self._last_record_time)
+            self._last_record_time = now
+        if self._max_time_per_record is None:
+            return None
+        return self._last_record_time + self._max_time_per_record
+
+    def time_since_last_record(self):
+        return time.time() - self._last_record_time
+
+
+class _RunResultCache(object):
+    """ Thread-safe mapping with at most max_size items. The least
+    recently used items are removed first. """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value # move to the end
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+
+class SandboxPool(object):
+    """ Pool of sandboxes - working directories inside 'folder' of an
+    Environment. A sandbox is a path as tuple, i. e. ('env', '0'). At most
+    one thread uses a sandbox at a time. Sandboxes are reused, so the number
+    of them is equal to the maximum number of concurrent users. """
+
+    def __init__(self, env, folder):
+        self._env = env
+        self._folder = folder
+        self._lock = threading.Lock()
+        self._free_sandboxes = []
+        self._sandboxes_count = 0
+
+    @contextmanager
+    def sandbox(self):
+        sandbox = self._acquire()
+        try:
+            yield sandbox
+        finally:
+            self._release(sandbox)
+
+    def clear(self, sandbox):
+        """ May raise OSError or IOError. """
+        self._env.remove_folder_recursively(sandbox)
+
+    def prepare(self, sandbox):
+        """ Make the sandbox an existing empty folder. Cheap if it's
+        already empty. May raise OSError or IOError. """
+        self._env.make_empty_folder(sandbox)
+
+    def _acquire(self):
+        with self._lock:
+            if self._free_sandboxes:
+                return self._free_sandboxes.pop()
+            self._sandboxes_count += 1
+            return (self._folder, str(self._sandboxes_count - 1))
+
+    def _release(self, sandbox):
+        with self._lock:
+            self._free_sandboxes.append(sandbox)
+
+
+_PYTHON_WORKER_SCRIPT = r"""
+import sys, traceback
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+requests = getattr(sys.stdin, 'buffer', sys.stdin)
+responses = getattr(sys.stdout, 'buffer', sys.stdout)
+# the worker executes only one program, so only its code is remembered
+cached_path, cached_code = None, None
+
+def encoded(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf8')
+    return text
+
+while True:
+    header = requests.readline().decode('utf8')
+    if not header:
+        break
+    path, input_length = header.rsplit(' ', 1)
+    input_data = requests.read(int(input_length))
+    if bytes is not str:
+        input_data = input_data.decode('utf8')
+
+    exit_code = 0
+    out, err = StringIO(), StringIO()
+    sys.stdin, sys.stdout, sys.stderr = StringIO(input_data), out, err
+    try:
+        if path != cached_path:
+            with open(path, 'rb') as stream:
+                code = compile(stream.read(), 'bin.py', 'exec')
+            cached_path, cached_code = path, code
+        exec(cached_code, {'__name__': '__main__',
+                           '__builtins__': dict(vars(builtins))})
+    except SystemExit as ex:
+        if ex.code is None:
+            exit_code = 0
+        elif isinstance(ex.code, int):
+            exit_code = ex.code
+        else:
+            err.write(str(ex.code) + '\n')
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = \
+            sys.__stdin__, sys.__stdout__, sys.__stderr__
+
+    output, errors_output = encoded(out.getvalue()), encoded(err.getvalue())
+    responses.write(('%d %d %d\n' % (exit_code, len(output),
+                                        len(errors_output))).encode('ascii'))
+    responses.write(output)
+    responses.write(errors_output)
+    responses.flush()
+"""
+
+
+class PythonWorkerPool(object):
+    """ Pool of long-lived Python interpreters (warm workers). A worker
+    loads (compiles) a program once and then executes it many times, so
+    the cost of starting interpreter is paid once per worker instead of
+    once per run.
+
+    Each run gets fresh globals and builtins and its own stdin, stdout and
+    stderr, but modules imported by programs stay loaded in the worker.
+    That's why a worker executes only one program (a worker per program
+    path, which contains its sha), so programs cannot change how other
+    programs work. At most size workers are kept idle; the least recently
+    used ones are killed first. A worker which exceeded the time limit or
+    died is killed and a new one is started when necessary.
+
+    The pool may be used concurrently from many threads. """
+
+    def __init__(self, interpreter_command, size, working_directory):
+        assert size > 0
+        self._argv = _split_command(interpreter_command) + \
+                     ['-u', '-c', _PYTHON_WORKER_SCRIPT]
+        self._working_directory = working_directory
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+        self._max_idle_workers = size
+        # list of pairs (program_path, worker), the least recently used
+        # first
+        self._idle_workers = []
+        self._all_workers = set()
+
+    def run(self, program_path, input_data, max_execution_time=None):
+        """ Execute program from file program_path. Return tuple (output,
+        error_output, killed, execution_time) like CompileAndRunProgram.
+        May raise OSError or IOError. """
+
+        with self._slots:
+            worker = self._acquire_worker(program_path)
+            try:
+                result = worker.run(program_path, input_data,
+                                    max_execution_time)
+            except (OSError, IOError):
+                self._discard_worker(worker)
+                raise
+            killed = result[2]
+            if killed:
+                self._discard_worker(worker)
+            else:
+                self._release_worker(program_path, worker)
+            return result
+
+    def close(self):
+        """ Kill idle workers. Busy workers are killed as soon as they
+        finish current run. """
+        with self._lock:
+            workers = [worker for _, worker in self._idle_workers]
+            self._all_workers.clear()
+            self._idle_workers = []
+        for worker in workers:
+            worker.kill()
+
+    def _acquire_worker(self, program_path):
+        with self._lock:
+            for i in xrange(len(self._idle_workers)-1, -1, -1):
+                if self._idle_workers[i][0] == program_path:
+                    return self._idle_workers.pop(i)[1]
+        if not os.path.exists(self._working_directory):
+            os.makedirs(self._working_directory)
+        worker = _PythonWorker(self._argv, self._working_directory)
+        with self._lock:
+            self._all_workers.add(worker)
+        return worker
+
+    def _release_worker(self, program_path, worker):
+        with self._lock:
+            if worker in self._all_workers: # the pool wasn't closed
+                self._idle_workers.append((program_path, worker))
+                worker = None
+                if len(self._idle_workers) > self._max_idle_workers:
+                    _, worker = self._idle_workers.pop(0)
+                    self._all_workers.discard(worker)
+        if worker is not None:
+            worker.kill()
+
+    def _discard_worker(self, worker):
+        worker.kill()
+        with self._lock:
+            self._all_workers.discard(worker)
+
+
+class _PythonWorker(object):
+    def __init__(self, argv, working_directory):
+        self._process = subprocess.Popen(argv,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=open(os.devnull, 'w'),
+                                         cwd=working_directory)
+
+    def run(self, program_path, input_data, max_execution_time):
+        if isinstance(input_data, unicode):
+            input_data = input_data.encode('utf8')
+        if isinstance(program_path, unicode):
+            program_path = program_path.encode('utf8')
+
+        # The watchdog kills the worker if it doesn't answer in time.
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            self.kill()
+        watchdog = None
+        if max_execution_time is not None:
+            watchdog = threading.Timer(max_execution_time, kill)
+
+        started_time = time.time()
+        if watchdog is not None:
+            watchdog.start()
+        header = ''
+        try:
+            self._process.stdin.write('%s %d\n' % (program_path,
+                                                     len(input_data)))
+            self._process.stdin.write(input_data)
+            self._process.stdin.flush()
+            header = self._process.stdout.readline()
+            if header:
+                exit_code, output_length, errors_output_length = \
+                    map(int, header.split())
+                output = self._process.stdout.read(output_length)
+                errors_output = self._process.stdout.read(errors_output_length)
+        except IOError:
+            pass # the worker was killed by the watchdog or it died
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+        execution_time = time.time() - started_time
+
+        # the worker died (i. e. the program called os._exit) or it was
+        # killed, so the program is treated as killed
+        if timed_out.is_set() or not header:
+            return (u'', u'', True, execution_time)
+        return (_decoded_output(output), _decoded_output(errors_output),
+                False, execution_time)
+
+    def kill(self):
+        _kill(self._process)
+        self._process.wait()
+
 
 class Environment(object):
     """
@@ -125,6 +979,10 @@ class Environment(object):
     def __init__(self, main_folder):
         self.main_folder = main_folder
 
+    def absolute_path(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        return os.path.abspath(path)
+
     def exists_file(self, dirty_path):
         iterable_path, path = self._cleaned_path(dirty_path)
         return os.path.exists(path) and os.path.isfile(path)
@@ -142,6 +1000,46 @@ class Environment(object):
         if os.path.exists(path):
             shutil.rmtree(path)
 
+    def read_file(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        with open(path, 'rb') as s:
+            return s.read()
+
+    def write_file_atomically(self, dirty_path, data):
+        """ Write (overwrite if necessary) binary data, so that other
+        threads and processes never see partially written file. """
+
+        iterable_path, path = self._cleaned_path(dirty_path)
+        self._create_folder_if_necessary_for_file(iterable_path)
+        temporary_path = '%s.tmp-%d-%d' % (path, os.getpid(),
+                                           thread.get_ident())
+        with open(temporary_path, 'wb') as s:
+            s.write(data)
+        if os.name != 'posix' and os.path.exists(path):
+            os.remove(path) # rename doesn't overwrite files under Windows
+        os.rename(temporary_path, path)
+
+    def remove_file(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        os.remove(path)
+
+    def file_size(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        return os.path.getsize(path)
+
+    def list_folder(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        return os.listdir(path)
+
+    def make_empty_folder(self, dirty_path):
+        iterable_path, path = self._cleaned_path(dirty_path)
+        if os.path.isdir(path):
+            if not os.listdir(path):
+                return
+            shutil.rmtree(path)
+        self._create_folder_if_necessary_for_file(iterable_path)
+        os.mkdir(path)
+
     def copy_file(self, source_path, destination_path):
         iterable_source_path, source_path = self._cleaned_path(source_path)
         iterable_destination_path, destination_path = self._cleaned_path(destination_path)
@@ -154,61 +1052,69 @@ class Environment(object):
         except OSError:
             pass
 
+    def copy_file_atomically(self, source_path, destination_path):
+        """ Like copy_file, but other threads and processes never see
+        partially copied destination file. """
+
+        iterable_destination_path, full_destination_path = \
+            self._cleaned_path(destination_path)
+        temporary_path = tuple(iterable_destination_path[1:-1]) + \
+            ('%s.tmp-%d-%d' % (iterable_destination_path[-1],
+                               os.getpid(), thread.get_ident()),)
+        iterable_temporary_path, full_temporary_path = \
+            self._cleaned_path(temporary_path)
+        if os.path.exists(full_temporary_path):
+            os.remove(full_temporary_path)
+        self.copy_file(source_path, temporary_path)
+        if os.path.exists(full_destination_path):
+            os.remove(full_temporary_path)
+            raise IOError("File with destination name exists")
+        os.rename(full_temporary_path, full_destination_path)
+
     def execute_bash_command(self, command, input_data, dirty_folder_path,
-                             max_execution_time=None):
+                             max_execution_time=None, max_output_size=None,
+                             on_output=None):
+        """ The process is killed if it's running longer than
+        max_execution_time seconds or if it writes more than
+        max_output_size bytes to stdout and stderr.
+
+        on_output is called with every chunk of stdout when it's read.
+        It may return new deadline (in time.time() units). """
+
+        return self._execute(command, True, input_data, dirty_folder_path,
+                             max_execution_time, max_output_size, on_output)
+
+    def execute_command(self, argv, input_data, dirty_folder_path,
+                        max_execution_time=None, max_output_size=None,
+                        on_output=None):
+        """ Like execute_bash_command, but the command is a list of
+        arguments and it's executed without shell. """
+
+        return self._execute(argv, False, input_data, dirty_folder_path,
+                             max_execution_time, max_output_size, on_output)
+
+    def _execute(self, command, shell, input_data, dirty_folder_path,
+                 max_execution_time, max_output_size, on_output):
         iterable_folder_path, folder = self._cleaned_path(dirty_folder_path)
+        started_time = time.time()
         process = subprocess.Popen(command,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE,
-                                   shell=True,
+                                   shell=shell,
                                    cwd=folder)
-
-        # pass input data to the process
-        try:
-            process.stdin.write(input_data)
-        except IOError as ex:
-            if ex.errno != 32: # not broken pipe error
-                raise
-        finally:
-            process.stdin.close()
-
-        # wait for finishing process or kill it
-        started_time = time.time()
-        elapsed_time = lambda: time.time() - started_time
-        killed = False
-        while process.poll() is None: # while process not terminated
-            if (max_execution_time is not None and
-                elapsed_time() > max_execution_time):
-                # kill the process
-                process.kill()
-                killed = True
-            else:
-                time.sleep(0.01)
-        execution_time = elapsed_time()
+        deadline = None
+        if max_execution_time is not None:
+            deadline = started_time + max_execution_time
+        output, errors_output, killed = \
+            _supervise_process(process, input_data, deadline,
+                               max_output_size, on_output)
+        execution_time = time.time() - started_time
         exit_code = process.returncode
 
-        # read output and finish
         if not killed:
-            output = process.stdout.read()
-            errors_output = process.stderr.read()
-
-            # We need to replace \r\n with \n under Windows. Decoding assumes
-            # that the encoding is utf8 which isn't always true --
-            # i. e. commands (under Windows) like `copy` produces output of
-            # which encoding depends on current code page which is defaultly
-            # cp850. So we use try-except clauses.
-            output = output.replace('\r\n', '\n')
-            errors_output = errors_output.replace('\r\n', '\n')
-            try:
-                output = output.decode('utf8')
-            except UnicodeDecodeError as e:
-                log_exception('unable to decode output')
-            try:
-                errors_output = errors_output.decode('utf8')
-            except UnicodeDecodeError as e:
-                log_exception('unable to decode output')
-
+            output = _decoded_output(output)
+            errors_output = _decoded_output(errors_output)
         else:
             output, errors_output = u'', u''
         return output, errors_output, exit_code, killed, execution_time
@@ -234,3 +1140,246 @@ class Environment(object):
         else:
             if not os.path.isdir(path):
                 raise IOError('Cannot create folder - the file with the same name exists.')
+
+
+def _supervise_process(process, input_data, deadline, max_output_size=None,
+                       on_output=None):
+    """ Pass input data to the process, collect its output and wait for
+    finishing it. The process is killed if it doesn't finish before
+    deadline (in time.time() units) or if its output is longer than
+    max_output_size. Return tuple (output, errors_output, killed).
+
+    on_output is called with every chunk of stdout as soon as the chunk is
+    read. If it returns a number, the number is the new deadline. """
+
+    if os.name == 'posix':
+        supervise = _supervise_with_select
+    else:
+        supervise = _supervise_with_threads
+    return supervise(process, input_data, deadline, max_output_size,
+                     on_output)
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        pass # the process has already terminated
+
+
+def _kill_and_wait(process):
+    _kill(process)
+    for stream in (process.stdin, process.stdout, process.stderr):
+        stream.close()
+    process.wait()
+
+
+_READ_CHUNK_SIZE = 64*1024
+
+
+def _supervise_with_select(process, input_data, deadline, max_output_size,
+                           on_output):
+    # Writing at most PIPE_BUF bytes to a pipe ready for writing never
+    # blocks.
+    write_chunk_size = getattr(select, 'PIPE_BUF', 512)
+    written = 0
+    writers = []
+    if input_data:
+        writers.append(process.stdin.fileno())
+    else:
+        process.stdin.close()
+    stdout_fd, stderr_fd = process.stdout.fileno(), process.stderr.fileno()
+    chunks_by_fds = {stdout_fd:[], stderr_fd:[]}
+    readers = [stdout_fd, stderr_fd]
+    output_size = 0
+
+    while readers or writers:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                _kill_and_wait(process)
+                return '', '', True
+        try:
+            ready_to_read, ready_to_write, _ = \
+                select.select(readers, writers, [], timeout)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in ready_to_write:
+            try:
+                written += os.write(
+                    fd, input_data[written:written+write_chunk_size])
+            except OSError as ex:
+                if ex.errno != errno.EPIPE:
+                    raise
+                written = len(input_data) # the process doesn't read more
+            if written >= len(input_data):
+                writers = []
+                process.stdin.close()
+
+        for fd in ready_to_read:
+            data = os.read(fd, _READ_CHUNK_SIZE)
+            if not data:
+                readers.remove(fd)
+                continue
+            chunks_by_fds[fd].append(data)
+            output_size += len(data)
+            if max_output_size is not None and output_size > max_output_size:
+                _kill_and_wait(process)
+                return '', '', True
+            if on_output is not None and fd == stdout_fd:
+                new_deadline = on_output(data)
+                if new_deadline is not None:
+                    deadline = new_deadline
+
+    # Both pipes are closed, so the process is (almost always) finished.
+    if process.poll() is None and deadline is not None:
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            _kill(process)
+        watchdog = threading.Timer(max(deadline - time.time(), 0), kill)
+        watchdog.start()
+        process.wait()
+        watchdog.cancel()
+        if timed_out.is_set():
+            return '', '', True
+    process.wait()
+    return ''.join(chunks_by_fds[stdout_fd]), \
+           ''.join(chunks_by_fds[stderr_fd]), \
+           False
+
+
+def _supervise_with_threads(process, input_data, deadline, max_output_size,
+                            on_output):
+    # select() doesn't support pipes under Windows, so every pipe has its
+    # own thread and a timer kills the process at the deadline.
+    lock = threading.Lock()
+    killed = threading.Event()
+    output_size = [0]
+    watchdog = [None]
+    finished = [False]
+
+    def kill():
+        killed.set()
+        _kill(process)
+
+    def set_deadline(deadline):
+        with lock:
+            if finished[0]:
+                return
+            if watchdog[0] is not None:
+                watchdog[0].cancel()
+            watchdog[0] = threading.Timer(max(deadline - time.time(), 0),
+                                          kill)
+            watchdog[0].start()
+
+    def write():
+        try:
+            process.stdin.write(input_data)
+        except IOError as ex:
+            if ex.errno not in (errno.EPIPE, errno.EINVAL):
+                raise
+        finally:
+            process.stdin.close()
+
+    def read(stream, chunks, on_output):
+        while True:
+            data = os.read(stream.fileno(), _READ_CHUNK_SIZE)
+            if not data:
+                break
+            chunks.append(data)
+            with lock:
+                output_size[0] += len(data)
+                exceeded = (max_output_size is not None and
+                            output_size[0] > max_output_size)
+            if exceeded:
+                kill()
+                break
+            if on_output is not None:
+                new_deadline = on_output(data)
+                if new_deadline is not None:
+                    set_deadline(new_deadline)
+
+    output_chunks, errors_output_chunks = [], []
+    threads = [threading.Thread(target=write),
+               threading.Thread(target=read,
+                                args=(process.stdout, output_chunks,
+                                      on_output)),
+               threading.Thread(target=read,
+                                args=(process.stderr, errors_output_chunks,
+                                      None))]
+    if deadline is not None:
+        set_deadline(deadline)
+    for t in threads:
+        t.daemon = True
+        t.start()
+    process.wait()
+    with lock:
+        finished[0] = True
+        if watchdog[0] is not None:
+            watchdog[0].cancel()
+    if killed.is_set():
+        # Don't wait for readers -- children of the process may still
+        # keep the pipes open.
+        return '', '', True
+    for t in threads:
+        t.join()
+    process.stdout.close()
+    process.stderr.close()
+    return ''.join(output_chunks), ''.join(errors_output_chunks), False
+
+
+_SHELL_SPECIAL_CHARACTERS = frozenset('|&;<>()$`\\*?[]{}~#!\n')
+
+
+def _running_argv_template(command, binary_file_name, source_file_name):
+    """ Split running command into arguments, where None stands for the
+    binary file. Return None if the command cannot be executed without
+    shell and without the sandbox containing the binary and source
+    files. """
+
+    if os.name != 'posix':
+        return None
+    if any(char in _SHELL_SPECIAL_CHARACTERS for char in command):
+        return None
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None
+    if not tokens or '=' in tokens[0]: # environment variable assignment
+        return None
+    normalized = [os.path.normpath(token) for token in tokens]
+    if source_file_name in normalized:
+        return None
+    template = [None if name == binary_file_name else token
+                for name, token in zip(normalized, tokens)]
+    if None not in template:
+        return None
+    return template
+
+
+def _split_command(command):
+    # Backslashes are path separators under Windows, not escape characters.
+    if os.name == 'nt':
+        return [token[1:-1] if len(token) > 1 and token[0] == token[-1] == '"'
+                else token
+                for token in shlex.split(command, posix=False)]
+    return shlex.split(command)
+
+
+def _decoded_output(output):
+    # We need to replace \r\n with \n under Windows. Decoding assumes
+    # that the encoding is utf8 which isn't always true --
+    # i. e. commands (under Windows) like `copy` produces output of
+    # which encoding depends on current code page which is defaultly
+    # cp850. So we use try-except clauses.
+    output = output.replace('\r\n', '\n')
+    try:
+        output = output.decode('utf8')
+    except UnicodeDecodeError as e:
+        log_exception('unable to decode output')
+    return output
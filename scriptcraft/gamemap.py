@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
+from array import array
+from collections import deque
 from copy import deepcopy
+import heapq
 
-from scriptcraft import aima, direction
+from scriptcraft import direction
 from scriptcraft.utils import *
 
 
@@ -20,6 +23,12 @@ class GameMap(object):
     INVALID_GROUND_TYPE = None
     MIN_GROUND_TYPE = 1
     MAX_GROUND_TYPE = 127
+    # returned by objects_in_row for fields outside map
+    OUTSIDE_MAP = Const('OUTSIDE_MAP')
+    # size of square buckets used by find_nearest_object_of_type
+    BUCKET_SIZE = 8
+    # maximum number of changes remembered by the change journal
+    MAX_JOURNAL_LENGTH = 4096
 
     def __init__(self, size=None, start_positions=None, raw_instance=False):
         if raw_instance:
@@ -34,32 +43,43 @@ class GameMap(object):
         self._free_start_positions = set(start_positions)
         self._size = size
 
-        # self._ground_types is dict {(x, y) : ground_type}
-        self._ground_types = dict(((x, y), GameMap.DEFAULT_GROUND_TYPE)
-                                  for x in xrange(size[0])
-                                  for y in xrange(size[1]))
-        # self._objs is dict {(x, y) : object on that field}
-        self._objs = {}
+        # Fields are stored row by row in flat arrays -- field (x, y) has
+        # index y*width + x. self._ground_types is array of ground types
+        # and self._objs is list of objects on fields (or Nones).
+        self._ground_types = array('B', [GameMap.DEFAULT_GROUND_TYPE]) * \
+                             (size[0]*size[1])
+        self._objs = [None] * (size[0]*size[1])
+        # self._ground_types may be shared with copies of the map; it's
+        # copied before the first change then
+        self._ground_types_shared = False
+        # self._objs_by_types is dict {type : {index : object}} and
+        # self._objs_by_buckets is dict {(type, bucket_x, bucket_y) :
+        # {index : object}}; they're not pickled
+        self._objs_by_types = {}
+        self._objs_by_buckets = {}
+        # self._journal is list of indexes of changed fields (see
+        # change_mark); self._journal_start is mark of its first change
+        self._journal = []
+        self._journal_start = 0
 
     def __getitem__(self, position):
-        valid_position = self._is_valid_position(position)
-        if valid_position:
-            ground_type = self._ground_types[position]
-            obj = self._objs.get(position, None)
-        else:
-            ground_type, obj = GameMap.INVALID_GROUND_TYPE, None
-
-        return Field(position, valid_position,
-                     ground_type, obj, game_map=self)
+        x, y = position
+        width, height = self._size
+        if 0 <= x < width and 0 <= y < height:
+            index = y*width + x
+            return Field(position, True, self._ground_types[index],
+                         self._objs[index], game_map=self)
+        return Field(position, False, GameMap.INVALID_GROUND_TYPE, None,
+                     game_map=self)
 
     def __setitem__(self, position, field):
-        if not self._is_valid_position(position):
+        if not self.is_valid_position(position):
             raise FieldOutsideMap('The position is outside map.')
         if field.position != position:
             raise ValueError('The field position was %r but you want assign '
                              'the field to %r.' % (field.position, position))
-        old_ground_type = self._ground_types[position]
-        old_obj = self._objs.get(position, None)
+        index = position[1]*self._size[0] + position[0]
+        old_obj = self._objs[index]
         if (old_obj is not None and
             field.maybe_object is not None and
             old_obj is not field.maybe_object):
@@ -71,28 +91,72 @@ class GameMap(object):
             ('Invalid ground type. Ground type must be integer '
              'between %r and %r' % (GameMap.MIN_GROUND_TYPE,
                                     GameMap.MAX_GROUND_TYPE))
-        self._ground_types[position] = field.ground_type
-        if field.maybe_object is None:
-            if position in self._objs:
-                del self._objs[position]
-        else:
-            self._objs[position] = field.maybe_object
+        if self._ground_types[index] != field.ground_type:
+            if self._ground_types_shared:
+                self._ground_types = array('B', self._ground_types)
+                self._ground_types_shared = False
+            self._ground_types[index] = field.ground_type
+        self._record_change(index)
+        if old_obj is not field.maybe_object:
+            if old_obj is not None:
+                self._unindex_object(index, old_obj)
+            if field.maybe_object is not None:
+                self._index_object(index, field.maybe_object)
+            self._objs[index] = field.maybe_object
 
     def __deepcopy__(self, memo):
+        """ Takes time proportional to number of objects on the map (not
+        its area). Ground types are copied on write. """
+
         result = GameMap(raw_instance=True)
         result._free_start_positions = deepcopy(self._free_start_positions, memo)
         result._size = deepcopy(self._size, memo)
-        def copied_objs():
-            for pos, obj in self._objs.iteritems():
+        result._objs = list(self._objs)
+        result._objs_by_types = {}
+        result._objs_by_buckets = {}
+        for objs in self._objs_by_types.itervalues():
+            for index, obj in objs.iteritems():
                 key = id(obj)
                 if key not in memo:
                     memo[key] = deepcopy(obj, memo)
-                yield (pos, memo[key])
-        result._objs = dict(copied_objs())
-        # self._ground_types are ints so we don't need to do deep copy
-        result._ground_types = self._ground_types.copy()
+                result._objs[index] = memo[key]
+                result._index_object(index, memo[key])
+        result._ground_types = self._ground_types
+        result._ground_types_shared = self._ground_types_shared = True
+        result._journal = list(self._journal)
+        result._journal_start = self._journal_start
         return result
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_objs_by_types']
+        del state['_objs_by_buckets']
+        state['_ground_types_shared'] = False
+        # the journal is kept, so caches pickled together with the map (see
+        # Game.__getstate__) are updated in the same way as in the original
+        state['_journal'] = list(self._journal)
+        return state
+
+    def __setstate__(self, state):
+        self._journal = []
+        self._journal_start = 0
+        self._ground_types_shared = False
+        self.__dict__.update(state)
+        if isinstance(self._ground_types, dict): # pickled by older version
+            width, height = self._size
+            ground_types, objs = self._ground_types, self._objs
+            self._ground_types = array('B', (ground_types[x, y]
+                                             for y in xrange(height)
+                                             for x in xrange(width)))
+            self._objs = [None] * (width*height)
+            for (x, y), obj in objs.iteritems():
+                self._objs[y*width + x] = obj
+        self._objs_by_types = {}
+        self._objs_by_buckets = {}
+        for index, obj in enumerate(self._objs):
+            if obj is not None:
+                self._index_object(index, obj)
+
     def __repr__(self):
         return "GameMap(%dx%d, id=0x%x)" % \
           (self._size[0], self._size[1], id(self))
@@ -101,13 +165,137 @@ class GameMap(object):
     def size(self):
         return self._size
 
+    def ground_types(self):
+        """ Return array of ground types of all fields (row by row). The
+        array mustn't be modified and it's not changed by the map later
+        (the map copies it before the next change). """
+
+        self._ground_types_shared = True
+        return self._ground_types
+
+    def objects(self):
+        """ Return iterator over pairs (position, object) of all objects
+        on the map. """
+
+        width = self._size[0]
+        return (((index % width, index // width), obj)
+                for index, obj in enumerate(self._objs)
+                if obj is not None)
+
+    def objects_of_type(self, cls):
+        """ Return list of pairs (position, object) of all objects being
+        instances of cls. Unlike objects(), it doesn't scan the map. """
+
+        width = self._size[0]
+        return [((index % width, index // width), obj)
+                for type_, objs in self._objs_by_types.iteritems()
+                if issubclass(type_, cls)
+                for index, obj in objs.iteritems()]
+
+    # Fast read-only access which doesn't create Field instances.
+
+    def find_nearest_object_of_type(self, center, range, cls,
+                                    condition=lambda obj: True):
+        """ Return the nearest object being instance of cls and
+        fulfilling condition in distance at most range from center or None
+        if there is no such object. Ties are broken by x and then by y.
+        Only buckets overlapping the range are checked, so it takes time
+        proportional to number of objects near center. """
+
+        width, height = self._size
+        bucket_size = GameMap.BUCKET_SIZE
+        types = [type_ for type_ in self._objs_by_types
+                 if issubclass(type_, cls)]
+        min_bucket_x = max(0, center[0]-range) // bucket_size
+        max_bucket_x = min(width-1, center[0]+range) // bucket_size
+        min_bucket_y = max(0, center[1]-range) // bucket_size
+        max_bucket_y = min(height-1, center[1]+range) // bucket_size
+        best_key, best_obj = None, None
+        for type_ in types:
+            for bucket_x in xrange(min_bucket_x, max_bucket_x+1):
+                for bucket_y in xrange(min_bucket_y, max_bucket_y+1):
+                    objs = self._objs_by_buckets.get(
+                        (type_, bucket_x, bucket_y), None)
+                    if not objs:
+                        continue
+                    for index, obj in objs.iteritems():
+                        position = (index % width, index // width)
+                        key = (distance(center, position),) + position
+                        if (key[0] <= range and
+                            (best_key is None or key < best_key) and
+                            condition(obj)):
+                            best_key, best_obj = key, obj
+        return best_obj
+
+    def is_valid_position(self, position):
+        return (0 <= position[0] < self._size[0] and
+                0 <= position[1] < self._size[1])
+
+    def is_accessible(self, x, y):
+        width, height = self._size
+        return (0 <= x < width and 0 <= y < height and
+                self._objs[y*width + x] is None)
+
+    def object_at(self, x, y):
+        """ Return None if there is no object or (x, y) is outside
+        map. """
+
+        width, height = self._size
+        if 0 <= x < width and 0 <= y < height:
+            return self._objs[y*width + x]
+        return None
+
+    def ground_at(self, x, y):
+        width, height = self._size
+        if 0 <= x < width and 0 <= y < height:
+            return self._ground_types[y*width + x]
+        return GameMap.INVALID_GROUND_TYPE
+
+    def objects_in_row(self, y, start_x, stop_x):
+        """ Return list of objects (or Nones) on fields (x, y) where
+        start_x <= x < stop_x. Fields outside map are represented by
+        GameMap.OUTSIDE_MAP. """
+
+        width, height = self._size
+        if not 0 <= y < height:
+            return [GameMap.OUTSIDE_MAP] * (stop_x - start_x)
+        left = max(start_x, 0)
+        right = min(stop_x, width)
+        if left >= right:
+            return [GameMap.OUTSIDE_MAP] * (stop_x - start_x)
+        return ([GameMap.OUTSIDE_MAP] * (left - start_x) +
+                self._objs[y*width + left:y*width + right] +
+                [GameMap.OUTSIDE_MAP] * (stop_x - right))
+
+    def change_mark(self):
+        """ Return mark of the current state of the map. See
+        changed_since. """
+
+        return self._journal_start + len(self._journal)
+
+    def changed_since(self, mark):
+        """ Return set of positions of fields changed since the mark was
+        returned by change_mark or None if the changes were forgotten. """
+
+        if mark < self._journal_start:
+            return None
+        width = self._size[0]
+        return set((index % width, index // width)
+                   for index in self._journal[mark-self._journal_start:])
+
+    def mark_changed(self, position):
+        """ Record change of the field at position which isn't done by
+        assignment to the map (i.e. number of minerals in deposit). """
+
+        self._record_change(position[1]*self._size[0] + position[0])
+
     def try_reserve_free_start_position(self):
         for position in self._free_start_positions:
-            all_neighbours_are_accessible = all(
-                neighbour.accessible for neighbour
-                in self._get_four_neighbours_of(position)
-            )
-            if self[position].accessible and all_neighbours_are_accessible:
+            x, y = position
+            all_neighbours_are_accessible = (
+                self.is_accessible(x-1, y) and self.is_accessible(x+1, y) and
+                self.is_accessible(x, y-1) and self.is_accessible(x, y+1))
+            if self.is_accessible(x, y) and all_neighbours_are_accessible:
                 self._free_start_positions.remove(position)
                 return position
         return None
@@ -122,16 +310,48 @@ class GameMap(object):
         problem = _FindPathProblem(source, destination, self)
         return problem.find_direction()
 
+    def find_path(self, source, destination):
+        """ Return list of positions of fields on path from source
+        (excluded) to destination (included) or None if there is no path or
+        computing it took too long time. """
+
+        problem = _FindPathProblem(source, destination, self)
+        return problem.find_path()
+
+    def _record_change(self, index):
+        self._journal.append(index)
+        if len(self._journal) > GameMap.MAX_JOURNAL_LENGTH:
+            forgotten = len(self._journal) // 2
+            del self._journal[:forgotten]
+            self._journal_start += forgotten
+
+    def _index_object(self, index, obj):
+        objs = self._objs_by_types.get(type(obj), None)
+        if objs is None:
+            objs = self._objs_by_types[type(obj)] = {}
+        objs[index] = obj
+        bucket = self._bucket_of(index, obj)
+        objs = self._objs_by_buckets.get(bucket, None)
+        if objs is None:
+            objs = self._objs_by_buckets[bucket] = {}
+        objs[index] = obj
+
+    def _unindex_object(self, index, obj):
+        del self._objs_by_types[type(obj)][index]
+        del self._objs_by_buckets[self._bucket_of(index, obj)][index]
+
+    def _bucket_of(self, index, obj):
+        width = self._size[0]
+        return (type(obj),
+                (index % width) // GameMap.BUCKET_SIZE,
+                (index // width) // GameMap.BUCKET_SIZE)
+
     def _get_four_neighbours_of(self, pos):
         return (self[pos[0]-1, pos[1]],
                 self[pos[0]+1, pos[1]],
                 self[pos[0], pos[1]-1],
                 self[pos[0], pos[1]+1])
 
-    def _is_valid_position(self, position):
-        return (0 <= position[0] < self._size[0] and
-                0 <= position[1] < self._size[1])
-
 
 class Field(object):
     __slots__ = ('_maybe_object',
@@ -194,18 +414,17 @@ class Field(object):
         self._game_map[self._position] = self
 
 
-class _TooLongSearchingTime(Exception):
-    pass
-
+class _FindPathProblem(object):
+    """ A* search over fields of map. Fields are identified by their
+    indexes (y*width + x); the heap contains triples (f, counter, index),
+    so nodes with the same f are expanded in order of adding them. """
 
-class _FindPathProblem(aima.search.Problem):
     ITERATIONS_LIMIT = 256
     MIN_DISTANCE_TO_USE_HEURA = 16
     H_COEFFICIENT_FOR_NON_HEURA = 1.0
     H_COEFFICIENT_FOR_HEURA = 1.03
 
     def __init__(self, start_position, destination, game_map):
-        aima.search.Problem.__init__(self, start_position, destination)
         self.start_position = start_position
         self.destination = destination
         self.game_map = game_map
@@ -213,32 +432,6 @@ class _FindPathProblem(aima.search.Problem):
         self.h_coefficient = (_FindPathProblem.H_COEFFICIENT_FOR_NON_HEURA
                               if dist < _FindPathProblem.MIN_DISTANCE_TO_USE_HEURA
                               else _FindPathProblem.H_COEFFICIENT_FOR_HEURA)
-        self.iteration = 0
-
-    def successor(self, state):
-        self.iteration += 1
-        if self.iteration >= _FindPathProblem.ITERATIONS_LIMIT:
-            raise _TooLongSearchingTime()
-
-        x, y = state
-        neighbour_positions = ((x - 1, y),
-                               (x, y - 1),
-                               (x + 1, y),
-                               (x, y + 1))
-        neighbours = [(None, position) for position in neighbour_positions
-                      if (self.game_map[position].accessible
-                          or position == self.destination)]
-        return neighbours
-
-    def goal_test(self, state):
-        return state == self.destination
-
-    def path_cost(self, c, state1, action, state2):
-        return c + 1
-
-    def h(self, node):
-        x, y = node.state
-        return distance((x, y), self.destination) * self.h_coefficient
 
     @log_on_enter('find path', mode='only time')
     def find_direction(self):
@@ -248,24 +441,676 @@ class _FindPathProblem(aima.search.Problem):
         if self.start_position == self.destination:
             return None
 
-        try:
-            result_node = aima.search.astar_search(self)
-        except _TooLongSearchingTime:
+        path = self.find_path()
+        if path is None: # no path found or too long searching time
             return None
 
-        if result_node == None: # no path found
+        next_field = path[0]
+        delta = (next_field[0] - self.start_position[0],
+                 next_field[1] - self.start_position[1])
+        if self.game_map.is_accessible(*next_field):
+            return direction.FROM_RAY[delta]
+        else:
             return None
 
-        path = result_node.path()
-        first_node, second_node = path[-1], path[-2]
-        delta = (second_node.state[0] - first_node.state[0],
-                 second_node.state[1] - first_node.state[1])
-        next_field = second_node.state
+    def find_path(self):
+        """ Return list of positions of fields on path (without
+        start_position) or None. """
+        width, height = self.game_map.size
+        objs = self.game_map._objs
+        start_x, start_y = self.start_position
+        goal_x, goal_y = self.destination
+        start = start_y*width + start_x
+        # the destination may be outside map; then its index is -1
+        goal = (goal_y*width + goal_x
+                if 0 <= goal_x < width and 0 <= goal_y < height
+                else -1)
+        h_coefficient = self.h_coefficient
+
+        g_scores = {start : 0}
+        parents = {start : -1}
+        closed = set()
+        counter = 0
+        heap = [(distance(self.start_position, self.destination)
+                 * h_coefficient, counter, start)]
+        iterations = 0
+        while heap:
+            _, _, index = heapq.heappop(heap)
+            if index == goal:
+                path = [self.destination]
+                index = parents[index]
+                while index != start:
+                    path.append((index % width, index // width))
+                    index = parents[index]
+                path.reverse()
+                return path
+            if index in closed:
+                continue
+            closed.add(index)
+
+            iterations += 1
+            if iterations >= _FindPathProblem.ITERATIONS_LIMIT:
+                return None
+
+            x, y = index % width, index // width
+            g = g_scores[index] + 1
+            for neighbour_x, neighbour_y, neighbour in \
+                ((x-1, y, index-1), (x, y-1, index-width),
+                 (x+1, y, index+1), (x, y+1, index+width)):
+                if neighbour_x == goal_x and neighbour_y == goal_y:
+                    neighbour = goal
+                elif not (0 <= neighbour_x < width and
+                          0 <= neighbour_y < height and
+                          objs[neighbour] is None):
+                    continue
+                if neighbour in closed or \
+                   g >= g_scores.get(neighbour, g+1):
+                    continue
+                g_scores[neighbour] = g
+                parents[neighbour] = index
+                counter += 1
+                h = (abs(neighbour_x-goal_x) + abs(neighbour_y-goal_y)) \
+                    * h_coefficient
+                heapq.heappush(heap, (g + h, counter, neighbour))
+        return None
 
-        if self.game_map[next_field].accessible:
-            return direction.FROM_RAY[delta]
+
+
+class FlowField(object):
+    """ Distances to destination from fields around it, computed by
+    breadth-first search starting at the destination. Objects are
+    obstacles, except the destination itself. The search is extended on
+    demand, so units going to the same destination share it. The distances
+    aren't updated when the map changes, so find_direction gives up
+    (returns UNKNOWN) when they may be out of date. """
+
+    # returned by find_direction if the direction must be found in another way
+    UNKNOWN = Const('UNKNOWN')
+
+    def __init__(self, game_map, destination):
+        assert game_map.is_valid_position(destination)
+        self.game_map = game_map
+        self.destination = destination
+        goal = destination[1]*game_map.size[0] + destination[0]
+        self._distances = {goal : 0}
+        self._frontier = deque([goal])
+
+    def find_direction(self, source,
+                       max_iterations=_FindPathProblem.ITERATIONS_LIMIT):
+        """ Return direction of the first step from source or None if
+        source is the destination. Return UNKNOWN if source wasn't reached
+        after extending the search by max_iterations fields or there is no
+        path or the first field is occupied now (the map could change after
+        computing distances). """
+
+        if source == self.destination:
+            return None
+
+        width, height = self.game_map.size
+        x, y = source
+        neighbours = [(neighbour_y*width + neighbour_x, (dx, dy))
+                      for neighbour_x, neighbour_y, dx, dy
+                      in ((x-1, y, -1, 0), (x, y-1, 0, -1),
+                          (x+1, y, 1, 0), (x, y+1, 0, 1))
+                      if (0 <= neighbour_x < width and
+                          0 <= neighbour_y < height)]
+        distances = self._distances
+        iterations = 0
+        while (self._frontier and iterations < max_iterations and
+               not any(index in distances for index, _ in neighbours)):
+            self._expand()
+            iterations += 1
+
+        reached = [(distances[index], i, index, delta)
+                   for i, (index, delta) in enumerate(neighbours)
+                   if index in distances]
+        if not reached:
+            return FlowField.UNKNOWN
+
+        _, _, index, delta = min(reached)
+        if self.game_map._objs[index] is not None:
+            return FlowField.UNKNOWN
+        return direction.FROM_RAY[delta]
+
+    def _expand(self):
+        width, height = self.game_map.size
+        objs = self.game_map._objs
+        distances = self._distances
+        index = self._frontier.popleft()
+        x, y = index % width, index // width
+        next_distance = distances[index] + 1
+        for neighbour_x, neighbour_y, neighbour in \
+            ((x-1, y, index-1), (x, y-1, index-width),
+             (x+1, y, index+1), (x, y+1, index+width)):
+            if (0 <= neighbour_x < width and 0 <= neighbour_y < height and
+                neighbour not in distances and objs[neighbour] is None):
+                distances[neighbour] = next_distance
+                self._frontier.append(neighbour)
+
+
+
+class ClusterGraph(object):
+    """ Abstraction of map used to find long paths (hierarchical A*).
+    The map is divided into square clusters. In the middle of each part of
+    border between two clusters where fields on both sides are free there
+    is an entrance -- pair of nodes of the graph. Nodes of the same cluster
+    are connected by edges with lengths of the shortest paths inside the
+    cluster.
+
+    Objects of ignored types (i.e. units) aren't obstacles, so the graph
+    is updated (see GameMap.change_mark) only for clusters where other
+    objects appeared or disappeared. The graph isn't bound to a map, so it
+    may be used with copies of the map.
+
+    Free fields are also labelled by connected components, so unreachable
+    destinations are rejected without searching. Labels are merged when
+    an obstacle disappears and computed again only when one appears. """
+
+    CLUSTER_SIZE = 16
+
+    def __init__(self, ignored_types=()):
+        self.ignored_types = ignored_types
+        # size and change mark of the map the graph was updated for
+        self._size = None
+        self._mark = None
+        # array of 1 for fields with obstacles and 0 for other fields
+        self._obstacles = None
+        # dict {(cluster, cluster) : list of (index, index)} where clusters
+        # are pairs (x, y) of neighbouring clusters (upper or left first)
+        self._entrances = {}
+        # dict {cluster : {index : list of (index, length)}}
+        self._edges = {}
+        # array of labels of connected components of fields (-1 for
+        # obstacles) or None if they must be computed again;
+        # self._merged_labels is dict {label : label} which contains
+        # parents of merged labels (see _find_label)
+        self._labels = None
+        self._merged_labels = {}
+
+    def are_connected(self, game_map, source, destination):
+        """ Return False if there is no path from source to destination
+        even if units of ignored types moved away. Source and destination
+        may be occupied. """
+
+        self._update(game_map)
+        if self._labels is None:
+            self._label_components()
+        return bool(self._components_around(source) &
+                    self._components_around(destination))
+
+    def find_waypoints(self, game_map, source, destination):
+        """ Return list of positions of fields on the way from source
+        (excluded) to destination (included) or None if there is no way. Two
+        next fields are in the same cluster or in neighbouring ones. The
+        destination itself may be occupied. """
+
+        assert game_map.is_valid_position(source)
+        assert game_map.is_valid_position(destination)
+
+        if not self.are_connected(game_map, source, destination):
+            return None
+        width = self._size[0]
+        start = source[1]*width + source[0]
+        goal = destination[1]*width + destination[0]
+        start_cluster = self._cluster_of(start)
+        from_start = self._search_cluster(start, start_cluster)
+        to_goal = self._search_to_goal(goal)
+        goal_x, goal_y = destination
+
+        def neighbours_of(index):
+            cluster = self._cluster_of(index)
+            result = list(self._edges[cluster].get(index, ()))
+            if index == start:
+                result.extend((node, from_start[node])
+                              for node in self._edges[start_cluster]
+                              if node in from_start)
+            if index in to_goal:
+                result.append((goal, to_goal[index]))
+            return result
+
+        g_scores = {start : 0}
+        parents = {start : -1}
+        closed = set()
+        counter = 0
+        heap = [(distance(source, destination), counter, start)]
+        while heap:
+            _, _, index = heapq.heappop(heap)
+            if index == goal:
+                waypoints = []
+                while index != start:
+                    waypoints.append((index % width, index // width))
+                    index = parents[index]
+                waypoints.reverse()
+                return waypoints
+            if index in closed:
+                continue
+            closed.add(index)
+
+            for neighbour, length in neighbours_of(index):
+                g = g_scores[index] + length
+                if neighbour in closed or \
+                   g >= g_scores.get(neighbour, g+1):
+                    continue
+                g_scores[neighbour] = g
+                parents[neighbour] = index
+                counter += 1
+                h = abs(neighbour % width - goal_x) + \
+                    abs(neighbour // width - goal_y)
+                heapq.heappush(heap, (g + h, counter, neighbour))
+        return None
+
+    def _update(self, game_map):
+        changes = None
+        if self._size == game_map.size:
+            changes = game_map.changed_since(self._mark)
+        self._mark = game_map.change_mark()
+
+        if changes is None:
+            self._size = game_map.size
+            self._obstacles = array('B', (self._is_obstacle(obj)
+                                          for obj in game_map._objs))
+            self._entrances = {}
+            self._edges = {}
+            self._labels = None
+            clusters_width, clusters_height = self._clusters_size()
+            self._connect(set((x, y)
+                              for x in xrange(clusters_width)
+                              for y in xrange(clusters_height)))
+            return
+
+        width = self._size[0]
+        changed_clusters = set()
+        for x, y in changes:
+            index = y*width + x
+            obstacle = self._is_obstacle(game_map._objs[index])
+            if obstacle != self._obstacles[index]:
+                self._obstacles[index] = obstacle
+                changed_clusters.add(self._cluster_of(index))
+                if obstacle:
+                    self._labels = None
+                elif self._labels is not None:
+                    self._label_free_field(index)
+        if changed_clusters:
+            self._connect(changed_clusters)
+
+    def _connect(self, clusters):
+        """ Find entrances on borders of the clusters and edges inside
+        them and their neighbours. """
+
+        clusters_width, clusters_height = self._clusters_size()
+        borders = set()
+        for x, y in clusters:
+            for neighbour_x, neighbour_y in ((x-1, y), (x, y-1),
+                                             (x+1, y), (x, y+1)):
+                if (0 <= neighbour_x < clusters_width and
+                    0 <= neighbour_y < clusters_height):
+                    borders.add(tuple(sorted(((x, y),
+                                              (neighbour_x, neighbour_y)))))
+        for border in borders:
+            self._entrances[border] = self._find_entrances(*border)
+
+        affected_clusters = set(clusters)
+        for border in borders:
+            affected_clusters.update(border)
+        for cluster in affected_clusters:
+            self._edges[cluster] = self._find_edges(cluster)
+
+    def _find_entrances(self, first_cluster, second_cluster):
+        width, height = self._size
+        size = ClusterGraph.CLUSTER_SIZE
+        obstacles = self._obstacles
+        if first_cluster[0] != second_cluster[0]: # vertical border
+            x = second_cluster[0]*size
+            start = first_cluster[1]*size
+            stop = min(start + size, height)
+            pairs = [(y*width + x-1, y*width + x)
+                     for y in xrange(start, stop)]
+        else: # horizontal border
+            y = second_cluster[1]*size
+            start = first_cluster[0]*size
+            stop = min(start + size, width)
+            pairs = [((y-1)*width + x, y*width + x)
+                     for x in xrange(start, stop)]
+
+        entrances = []
+        run = []
+        for first, second in pairs + [(None, None)]:
+            if (first is not None and
+                not obstacles[first] and not obstacles[second]):
+                run.append((first, second))
+            elif run:
+                entrances.append(run[len(run)//2])
+                run = []
+        return entrances
+
+    def _find_edges(self, cluster):
+        x, y = cluster
+        edges = {}
+        for neighbour in ((x-1, y), (x, y-1), (x+1, y), (x, y+1)):
+            border = tuple(sorted((cluster, neighbour)))
+            for first, second in self._entrances.get(border, ()):
+                if self._cluster_of(first) != cluster:
+                    first, second = second, first
+                edges.setdefault(first, []).append((second, 1))
+
+        for node in edges.keys():
+            distances = self._search_cluster(node, cluster)
+            edges[node].extend((other, distances[other])
+                               for other in edges
+                               if other != node and other in distances)
+        return edges
+
+    def _search_to_goal(self, goal):
+        """ Return dict {index : distance to goal} of free fields which
+        may be reached from the goal without leaving its cluster. If the
+        goal is obstacle, it's reached through its free neighbours, which
+        may be in other clusters; then the search is done in their
+        clusters. """
+
+        if not self._obstacles[goal]:
+            return self._search_cluster(goal, self._cluster_of(goal))
+
+        width, height = self._size
+        x, y = goal % width, goal // width
+        result = {}
+        for neighbour_x, neighbour_y, neighbour in \
+            ((x-1, y, goal-1), (x, y-1, goal-width),
+             (x+1, y, goal+1), (x, y+1, goal+width)):
+            if not (0 <= neighbour_x < width and 0 <= neighbour_y < height and
+                    not self._obstacles[neighbour]):
+                continue
+            distances = self._search_cluster(neighbour,
+                                             self._cluster_of(neighbour))
+            for index, length in distances.iteritems():
+                if length + 1 < result.get(index, length + 2):
+                    result[index] = length + 1
+        return result
+
+    def _search_cluster(self, start, cluster):
+        """ Return dict {index : distance} of free fields of the cluster
+        reachable from start (which may be occupied) without leaving the
+        cluster. """
+
+        width, height = self._size
+        size = ClusterGraph.CLUSTER_SIZE
+        min_x, min_y = cluster[0]*size, cluster[1]*size
+        max_x = min(min_x + size, width) - 1
+        max_y = min(min_y + size, height) - 1
+        obstacles = self._obstacles
+        distances = {start : 0}
+        queue = deque([start])
+        while queue:
+            index = queue.popleft()
+            x, y = index % width, index // width
+            next_distance = distances[index] + 1
+            for neighbour_x, neighbour_y, neighbour in \
+                ((x-1, y, index-1), (x, y-1, index-width),
+                 (x+1, y, index+1), (x, y+1, index+width)):
+                if (min_x <= neighbour_x <= max_x and
+                    min_y <= neighbour_y <= max_y and
+                    neighbour not in distances and not obstacles[neighbour]):
+                    distances[neighbour] = next_distance
+                    queue.append(neighbour)
+        return distances
+
+    def _label_components(self):
+        width, height = self._size
+        obstacles = self._obstacles
+        labels = self._labels = array('i', [-1]) * (width*height)
+        self._merged_labels = {}
+        for start in xrange(width*height):
+            if obstacles[start] or labels[start] != -1:
+                continue
+            label = start
+            self._merged_labels[label] = label
+            labels[start] = label
+            queue = deque([start])
+            while queue:
+                index = queue.popleft()
+                x, y = index % width, index // width
+                for neighbour_x, neighbour_y, neighbour in \
+                    ((x-1, y, index-1), (x, y-1, index-width),
+                     (x+1, y, index+1), (x, y+1, index+width)):
+                    if (0 <= neighbour_x < width and
+                        0 <= neighbour_y < height and
+                        labels[neighbour] == -1 and not obstacles[neighbour]):
+                        labels[neighbour] = label
+                        queue.append(neighbour)
+
+    def _label_free_field(self, index):
+        """ Label field which was obstacle and merge components of its
+        neighbours. """
+
+        roots = set(self._find_label(label)
+                    for label in self._labels_of_neighbours(index))
+        label = roots.pop() if roots else index
+        self._merged_labels.setdefault(label, label)
+        for other in roots:
+            self._merged_labels[other] = label
+        self._labels[index] = label
+
+    def _find_label(self, label):
+        merged_labels = self._merged_labels
+        while merged_labels[label] != label:
+            merged_labels[label] = merged_labels[merged_labels[label]]
+            label = merged_labels[label]
+        return label
+
+    def _components_around(self, position):
+        """ Return set of components of the field or of its neighbours
+        if it's obstacle. """
+
+        index = position[1]*self._size[0] + position[0]
+        if self._labels[index] != -1:
+            labels = (self._labels[index],)
         else:
+            labels = self._labels_of_neighbours(index)
+        return set(self._find_label(label) for label in labels)
+
+    def _labels_of_neighbours(self, index):
+        width, height = self._size
+        x, y = index % width, index // width
+        return [self._labels[neighbour]
+                for neighbour_x, neighbour_y, neighbour in
+                ((x-1, y, index-1), (x, y-1, index-width),
+                 (x+1, y, index+1), (x, y+1, index+width))
+                if (0 <= neighbour_x < width and 0 <= neighbour_y < height and
+                    self._labels[neighbour] != -1)]
+
+    def _is_obstacle(self, obj):
+        return obj is not None and not isinstance(obj, self.ignored_types)
+
+    def _cluster_of(self, index):
+        width = self._size[0]
+        return ((index % width) // ClusterGraph.CLUSTER_SIZE,
+                (index // width) // ClusterGraph.CLUSTER_SIZE)
+
+    def _clusters_size(self):
+        size = ClusterGraph.CLUSTER_SIZE
+        return ((self._size[0] + size - 1) // size,
+                (self._size[1] + size - 1) // size)
+
+
+
+class PathCache(object):
+    """ Paths found by A* remembered by keys (i.e. units IDs), so they're
+    reused in the next turns. A path is checked against changes of the map
+    since the last use (see GameMap.change_mark). If a change blocks it,
+    only the blocked part is searched again.
+
+    If cluster graph is given, long paths are found with it. Then only
+    the path to the next waypoint is searched by A* at once. """
+
+    def __init__(self, cluster_graph=None):
+        self.cluster_graph = cluster_graph
+        # dict {key : _CachedPath}
+        self._paths = {}
+
+    def find_direction(self, game_map, key, source, destination):
+        """ Like GameMap.find_direction, but the path from source to
+        destination is remembered under the key. """
+
+        if source == destination:
+            return None
+
+        cached = self._paths.get(key, None)
+        if (cached is None or cached.destination != destination or
+            not cached.update(game_map, source)):
+            cached = self._find_path(game_map, source, destination)
+            if cached is None:
+                self._paths.pop(key, None)
+                return None
+            self._paths[key] = cached
+
+        next_field = cached.path[cached.next]
+        if not game_map.is_accessible(*next_field):
             return None
+        delta = (next_field[0] - source[0], next_field[1] - source[1])
+        return direction.FROM_RAY[delta]
+
+    def has_path(self, key, destination):
+        cached = self._paths.get(key, None)
+        return cached is not None and cached.destination == destination
+
+    def forget(self, key):
+        self._paths.pop(key, None)
+
+    def _find_path(self, game_map, source, destination):
+        """ Short paths are searched directly. Use the cluster graph if
+        it's too far or A* gave up. A* is the last resort if the cluster
+        graph found nothing. """
+
+        use_cluster_graph = (self.cluster_graph is not None and
+                             game_map.is_valid_position(destination))
+        if use_cluster_graph and not self.cluster_graph.are_connected(
+                game_map, source, destination):
+            return None
+        near = distance(source, destination) < ClusterGraph.CLUSTER_SIZE
+        if not use_cluster_graph or near:
+            cached = self._find_path_with_a_star(game_map, source,
+                                                 destination)
+            if cached is not None or not use_cluster_graph:
+                return cached
+
+        waypoints = self.cluster_graph.find_waypoints(game_map, source,
+                                                      destination)
+        if waypoints is None:
+            if near:
+                return None
+            return self._find_path_with_a_star(game_map, source, destination)
+        cached = _CachedPath(game_map, source, [], waypoints)
+        if not cached.update(game_map, source):
+            return None
+        return cached
+
+    def _find_path_with_a_star(self, game_map, source, destination):
+        path = game_map.find_path(source, destination)
+        if path is None:
+            return None
+        return _CachedPath(game_map, source, path)
+
+
+class _CachedPath(object):
+    __slots__ = ('source', 'destination', 'path', 'next', 'fields', 'mark',
+                 'waypoints')
+
+    def __init__(self, game_map, source, path, waypoints=()):
+        self.source = source
+        # positions to go through after reaching the end of self.path
+        self.waypoints = list(waypoints)
+        self.destination = self.waypoints[-1] if self.waypoints else path[-1]
+        self.path = path # path[self.next] is the next step from self.source
+        self.next = 0
+        self.fields = set(path)
+        self.mark = game_map.change_mark()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for name in _CachedPath.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def update(self, game_map, source):
+        """ Follow the move to source and repair the path if it's blocked
+        by changes of map. Return False if it cannot be done. """
+
+        if source != self.source:
+            if self.next == len(self.path) or source != self.path[self.next]:
+                return False
+            self.fields.discard(source)
+            self.source = source
+            self.next += 1
+
+        if self.next == len(self.path) or (
+            self.waypoints and not game_map.is_accessible(*self.path[-1])):
+            return self._refine(game_map)
+
+        changes = game_map.changed_since(self.mark)
+        if changes is None:
+            return False
+        self.mark = game_map.change_mark()
+        changes &= self.fields
+
+        # replace each blocked part of the path by a detour from the field
+        # before it to the first accessible field after it
+        while True:
+            blocked = [i for i in xrange(self.next, len(self.path)-1)
+                       if (self.path[i] in changes and
+                           not game_map.is_accessible(*self.path[i]))]
+            if not blocked:
+                break
+            first = rejoin = blocked[0]
+            while (rejoin < len(self.path)-1 and
+                   not game_map.is_accessible(*self.path[rejoin])):
+                rejoin += 1
+            start = self.path[first-1] if first > self.next else self.source
+            detour = game_map.find_path(start, self.path[rejoin])
+            if detour is None:
+                return False
+            self.path = _cut_loops(self.source,
+                                   self.path[self.next:first] + detour +
+                                   self.path[rejoin+1:])
+            self.next = 0
+            self.fields = set(self.path)
+            if not self.path:
+                return False
+        return True
+
+    def _refine(self, game_map):
+        """ Find path to the next waypoint. Occupied waypoints (except
+        the destination) are skipped. """
+
+        waypoints = self.waypoints
+        while len(waypoints) > 1 and (
+            waypoints[0] == self.source or
+            not game_map.is_accessible(*waypoints[0])):
+            del waypoints[0]
+        if not waypoints or waypoints[0] == self.source:
+            return False
+        path = game_map.find_path(self.source, waypoints.pop(0))
+        if path is None:
+            return False
+        self.path = path
+        self.next = 0
+        self.fields = set(path)
+        self.mark = game_map.change_mark()
+        return True
+
+
+def _cut_loops(source, path):
+    """ Return path without parts going back to fields visited before
+    (source is the field before the first one). A detour may go back
+    along the path if it's the only way around an obstacle. """
+
+    last_indexes = dict((position, i) for i, position in enumerate(path))
+    result = []
+    i = last_indexes.get(source, -1) + 1
+    while i < len(path):
+        result.append(path[i])
+        i = last_indexes[path[i]] + 1
+    return result
 
 
 
@@ -3,7 +3,7 @@
 
 
 import ConfigParser
-import copy
+import multiprocessing
 try:
     import cPickle as pickle
 except:
@@ -11,8 +11,8 @@ except:
 import os
 import threading
 
-from scriptcraft.compilation import CompileAndRunProgram
-from scriptcraft.gamestate import Language
+from scriptcraft.compilation import CompileAndRunProgram, PythonWorkerPool
+from scriptcraft.gamestate import Language, Program, RenderSnapshot
 from scriptcraft.utils import *
 
 
@@ -23,11 +23,14 @@ class AlreadyExecuteGame(Exception):
 
 class LanguageConfiguration(object):
     def __init__(self, source_file_name, binary_file_name,
-                 compilation_command, running_command):
+                 compilation_command, running_command,
+                 warm_workers=0, interpreter=None):
         self.source_file_name = source_file_name
         self.binary_file_name = binary_file_name
         self.compilation_command = compilation_command
         self.running_command = running_command
+        self.warm_workers = warm_workers
+        self.interpreter = interpreter
 
 
 class SystemConfiguration(object):
@@ -58,6 +61,54 @@ class SystemConfiguration(object):
           config.getfloat('DEFAULT', 'executinglimit')
         if self.max_execution_time == 0.0:
             self.max_execution_time = None
+        # number of programs executed at the same time; 0 means one
+        # program per processor
+        if config.has_option('DEFAULT', 'workers'):
+            self.max_workers = config.getint('DEFAULT', 'workers')
+        else:
+            self.max_workers = 1
+        if self.max_workers < 0:
+            raise ValueError("Option 'workers' cannot be negative.")
+        if self.max_workers == 0:
+            self.max_workers = multiprocessing.cpu_count()
+        # maximum size of program output in bytes; 0 means no limit
+        self.max_output_size = None
+        if config.has_option('DEFAULT', 'outputlimit'):
+            self.max_output_size = config.getint('DEFAULT', 'outputlimit')
+            if self.max_output_size < 0:
+                raise ValueError("Option 'outputlimit' cannot be negative.")
+            if self.max_output_size == 0:
+                self.max_output_size = None
+        # number of remembered outputs of deterministic programs; 0 means
+        # that outputs are never memoized
+        self.max_memoized_outputs = 1024
+        if config.has_option('DEFAULT', 'memoizedoutputs'):
+            self.max_memoized_outputs = \
+              config.getint('DEFAULT', 'memoizedoutputs')
+            if self.max_memoized_outputs < 0:
+                raise ValueError("Option 'memoizedoutputs' cannot be "
+                                 "negative.")
+        # if true, all programs are treated as deterministic, so their
+        # outputs are memoized (see Game.memoize_outputs)
+        self.memoize_outputs = False
+        if config.has_option('DEFAULT', 'deterministicprograms'):
+            self.memoize_outputs = \
+              config.getboolean('DEFAULT', 'deterministicprograms')
+        # if false, inputs of programs are dropped after they're executed
+        # (see Game.keep_run_inputs)
+        self.keep_run_inputs = True
+        if config.has_option('DEFAULT', 'keepruninputs'):
+            self.keep_run_inputs = \
+              config.getboolean('DEFAULT', 'keepruninputs')
+        # maximum total size of compiled programs in bytes; 0 means no
+        # limit
+        self.max_cache_size = None
+        if config.has_option('DEFAULT', 'cachelimit'):
+            self.max_cache_size = config.getint('DEFAULT', 'cachelimit')
+            if self.max_cache_size < 0:
+                raise ValueError("Option 'cachelimit' cannot be negative.")
+            if self.max_cache_size == 0:
+                self.max_cache_size = None
 
         for section in sections:
             language = SystemConfiguration.SECTION_TO_LANGUAGE.get(
@@ -76,13 +127,28 @@ class SystemConfiguration(object):
             binary_extension = config.get(section, 'binaryextension')
             compile_command = config.get(section, 'compile')
             execute_command = config.get(section, 'execute')
+            # number of long-lived interpreters executing programs (only
+            # for Python); 0 means that warm workers are not used
+            warm_workers = 0
+            interpreter = None
+            if language == Language.PYTHON:
+                if config.has_option(section, 'warmworkers'):
+                    warm_workers = config.getint(section, 'warmworkers')
+                if warm_workers < 0:
+                    raise ValueError("Option 'warmworkers' cannot be "
+                                     "negative.")
+                interpreter = 'python'
+                if config.has_option(section, 'interpreter'):
+                    interpreter = config.get(section, 'interpreter')
             self.languages_configurations[language] = LanguageConfiguration(
                 'src.'+source_extension, 'bin.'+binary_extension,
-                compile_command, execute_command)
+                compile_command, execute_command,
+                warm_workers, interpreter)
 
 
 class GameSession(object):
     GAME_FILE_PATH = 'game.gam'
+    WARM_WORKERS_DIRECTORY = 'warm'
     PICKLE_PROTOCOL = 2
 
     def __init__(self, directory, system_configuration, game=None):
@@ -93,39 +159,77 @@ class GameSession(object):
             self.game = game
         else:
             self.game = pickle.load(open(self._game_file, 'rb'))
+        self._configure_game(self.game)
+        # snapshot of self.game built after the last turn; the next one is
+        # built by the thread simulating the turn
+        self.render_snapshot = RenderSnapshot(self.game)
         self._already_execute_game_turn = False
         self._set_program_queue = []
+        # It's shared by all turns, so its sandboxes are reused.
+        self._compile_and_run = self._build_compile_and_run_program()
 
     def save(self):
         """ Save game. May raise errors. """
         pickle.dump(self.game, open(self._game_file, 'wb'),
                     GameSession.PICKLE_PROTOCOL)
 
+    def close(self):
+        """ Stop all processes started by the session. """
+        self._compile_and_run.close()
+
     def tic(self, queue):
         if self._already_execute_game_turn:
             raise AlreadyExecuteGame()
         self._already_execute_game_turn = True
-        with log_on_enter('copying game', mode='only time'):
-            game = copy.deepcopy(self.game)
+        with log_on_enter('forking game', mode='only time'):
+            game = self.game.fork()
         target = lambda: self._tic_async(queue, game)
         thread = threading.Thread(target=target)
         thread.start()
 
-    def _tic_async(self, queue, game):
+    def _configure_game(self, game):
+        """ Apply options of the system configuration to the game (also
+        to a loaded one). """
+
+        game.memoize_outputs = self._system_configuration.memoize_outputs
+        game.keep_run_inputs = self._system_configuration.keep_run_inputs
+
+    def _build_compile_and_run_program(self):
         languages = self._system_configuration.languages_configurations.items()
         source_file_names = dict([(k, v.source_file_name) for k, v in languages])
         binary_file_names = dict([(k, v.binary_file_name) for k, v in languages])
         compilation_commands = dict([(k, v.compilation_command) for k, v in languages])
         running_commands = dict([(k, v.running_command) for k, v in languages])
-        compile_and_run = CompileAndRunProgram(
+        warm_worker_pools = {}
+        for language, configuration in languages:
+            if configuration.warm_workers > 0:
+                assert language == Language.PYTHON
+                warm_worker_pools[language] = PythonWorkerPool(
+                    configuration.interpreter,
+                    configuration.warm_workers,
+                    os.path.join(self._directory,
+                                 GameSession.WARM_WORKERS_DIRECTORY))
+        return CompileAndRunProgram(
             self._directory,
             source_file_names,
             binary_file_names,
             compilation_commands,
             running_commands,
             self._system_configuration.max_compilation_time,
-            self._system_configuration.max_execution_time)
-        game.tic(compile_and_run)
+            self._system_configuration.max_execution_time,
+            warm_worker_pools,
+            self._system_configuration.max_output_size,
+            self._system_configuration.max_memoized_outputs,
+            self._system_configuration.max_cache_size,
+            self._system_configuration.max_workers)
+
+    def _tic_async(self, queue, game):
+        game.tic(self._compile_and_run,
+                 self._system_configuration.max_workers)
+        log('compile cache: %(hits)d hits, %(misses)d misses '
+            '(hit ratio %(hit_ratio).2f), %(binaries)d binaries '
+            '(%(size)d bytes), %(failures)d failures'
+            % self._compile_and_run.compile_cache.statistics())
 
         # apply new programs
         set_program_queue = self._set_program_queue
@@ -136,11 +240,19 @@ class GameSession(object):
                 game.set_program(unit, program)
 
         # finish!
+        self.render_snapshot = RenderSnapshot(game)
         self.game = game
         queue.put('ready')
         self._already_execute_game_turn = False
 
     def set_program(self, unit, program):
+        """ The program is compiled in background, so the next turn
+        doesn't wait for compilation (unless it's still in progress). """
+
+        if (isinstance(program, Program) and program.language in
+            self._system_configuration.languages_configurations):
+            self._compile_and_run.compile_in_background(program.language,
+                                                        program.code)
         if self._already_execute_game_turn:
             self._set_program_queue.append((unit.ID, program))
         else:
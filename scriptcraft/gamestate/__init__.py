@@ -36,7 +36,8 @@ import random
 
 from scriptcraft import direction
 from scriptcraft.compilation import CompileAndRunProgram
-from scriptcraft.gamemap import FieldIsOccupied, GameMap
+from scriptcraft.gamemap import (ClusterGraph, FieldIsOccupied, FlowField,
+                                 GameMap, PathCache)
 from scriptcraft.gamestate import cmds, actions
 from scriptcraft.parser import Parser, parse_system_question
 from scriptcraft.utils import *
@@ -67,6 +68,23 @@ _parser = Parser(cmds.ALL_COMMANDS)
 
 
 class Game(object):
+    # If True, all programs are treated as deterministic, so their outputs
+    # may be memoized (see CompileAndRunProgram). GameSession sets it
+    # from the system configuration.
+    memoize_outputs = False
+    # If False, inputs of programs are dropped from run statuses after the
+    # programs are executed (RunStatus.input is None), so they don't take
+    # memory and aren't copied in every turn. GameSession sets it from the
+    # system configuration.
+    keep_run_inputs = True
+    # created lazily; the input layer isn't pickled, but the path cache
+    # is, so a loaded game moves units the same way as the saved one would
+    _input_layer = None
+    _path_cache = None
+    # dict {destination : FlowField or None} used only during
+    # _execute_commands
+    _flow_fields_by_destinations = None
+
     def __init__(self, game_map, game_configuration):
         self.game_map = game_map
         self.units_by_IDs = {}
@@ -77,6 +95,28 @@ class Game(object):
         self.inbox = []
         self.outbox = []
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_input_layer', None)
+        return state
+
+    def fork(self):
+        """ Return copy of the game, so the copy can simulate the next
+        turn and this game stays unchanged for readers.
+
+        The configuration (with units types) and immutable parts of the
+        map are shared by both games. Caches used to simulate turns are
+        moved to the copy. """
+
+        memo = {id(self.configuration) : self.configuration}
+        for unit_type in self.configuration.units_types_by_names.itervalues():
+            memo[id(unit_type)] = unit_type
+        input_layer, path_cache = self._input_layer, self._path_cache
+        self._input_layer = self._path_cache = None
+        result = deepcopy(self, memo)
+        result._input_layer, result._path_cache = input_layer, path_cache
+        return result
+
     def new_player(self, name, color):
         """ May raise NoFreeStartPosition """
 
@@ -133,6 +173,10 @@ class Game(object):
         unit.player.remove_unit(unit)
         del self.units_by_IDs[unit.ID]
         self.game_map[unit.position].place_object(None)
+        if self._input_layer is not None:
+            self._input_layer.forget(unit.ID)
+        if self._path_cache is not None:
+            self._path_cache.forget(unit.ID)
 
     def move_unit_at(self, unit, new_position):
         field = self.game_map[new_position]
@@ -193,6 +237,7 @@ class Game(object):
 
         mineral_deposit.minerals -= 1
         destination_unit.minerals += 1
+        self.game_map.mark_changed(source_position)
 
     def store_minerals_from_unit_to_unit(self, source_unit,
                                          destination_unit):
@@ -206,9 +251,17 @@ class Game(object):
         destination_unit.minerals += 1
 
     @log_on_enter('tic method in Game', mode='time')
-    def tic(self, compile_and_run_function):
+    def tic(self, compile_and_run_function, max_workers=1):
+        """ Simulate one turn of the game.
+
+        Programs of units are executed concurrently by at most max_workers
+        threads, but only if compile_and_run_function declares that it can
+        be called concurrently (it has true 'reentrant' attribute). Results
+        are always applied in order of units IDs, so the course of the game
+        doesn't depend on max_workers. """
+
         self._tic_for_world()
-        self._compile_and_run_programs(compile_and_run_function)
+        self._compile_and_run_programs(compile_and_run_function, max_workers)
         self._clear_mailboxes()
         self._analise_outputs()
         self._validate_and_send_messages()
@@ -216,8 +269,15 @@ class Game(object):
         self._execute_commands()
 
     @log_on_enter('compile and run all programs', mode='time')
-    def _compile_and_run_programs(self, compile_and_run_function):
-        for unit in self.units_by_IDs.itervalues():
+    def _compile_and_run_programs(self, compile_and_run_function,
+                                  max_workers=1):
+        if not getattr(compile_and_run_function, 'reentrant', False):
+            max_workers = 1
+
+        # generate inputs and execute programs which don't need compilation
+        units_with_inputs = []
+        for unit_ID in sorted(self.units_by_IDs):
+            unit = self.units_by_IDs[unit_ID]
             input = self._generate_input_for(unit)
 
             if isinstance(unit.program, Program):
@@ -230,24 +290,7 @@ class Game(object):
                         execution_time=0.0)
 
                 else:
-                    status = compile_and_run_function(unit.program.language,
-                                                      unit.program.code,
-                                                      input,)
-                    maybe_compilation_status, maybe_running_status = status
-                    if maybe_compilation_status:
-                        output, error_output, killed, execution_time = \
-                          maybe_compilation_status
-                        compilation_status = CompilationStatus( \
-                          output, error_output, killed, execution_time)
-                        unit.maybe_last_compilation_status = compilation_status
-                    if maybe_running_status:
-                        output, error_output, killed, execution_time = \
-                          maybe_running_status
-                        running_status = RunStatus(input, output, error_output,
-                                                   killed, execution_time)
-                        unit.maybe_run_status = running_status
-                    else:
-                        unit.maybe_run_status = None
+                    units_with_inputs.append((unit, input))
 
             elif unit.program == STAR_PROGRAM:
                 unit.maybe_run_status = run_star_program(input)
@@ -255,6 +298,78 @@ class Game(object):
             else:
                 unit.maybe_run_status = None
 
+        # units executing the same program supporting batch mode are
+        # grouped, so the program is executed once for all of them; big
+        # groups are split, so they're executed by all workers
+        tasks = []
+        supports_batch = getattr(compile_and_run_function,
+                                 'supports_batch', None)
+        tasks_by_programs = {}
+        for unit, input in units_with_inputs:
+            program = unit.program
+            if supports_batch is not None and \
+               supports_batch(program.language, program.code):
+                key = (program.language, program.code)
+                if key not in tasks_by_programs:
+                    tasks_by_programs[key] = []
+                    tasks.append(tasks_by_programs[key])
+                tasks_by_programs[key].append((unit, input))
+            else:
+                tasks.append([(unit, input)])
+        if max_workers > 1:
+            tasks = [chunk
+                     for task in tasks
+                     for chunk in _split_into_chunks(task, max_workers)]
+
+        # compile and run the rest of programs
+        kwargs = {'deterministic':True} if self.memoize_outputs else {}
+        def compile_and_run(task):
+            program = task[0][0].program
+            if len(task) == 1:
+                return [compile_and_run_function(program.language,
+                                                 program.code,
+                                                 task[0][1],
+                                                 **kwargs)]
+            inputs = [input for unit, input in task]
+            compilation_status, running_statuses = \
+                compile_and_run_function.run_many(program.language,
+                                                  program.code,
+                                                  inputs,
+                                                  **kwargs)
+            return [(compilation_status, running_status)
+                    for running_status in running_statuses]
+        statuses_of_tasks = parallel_map(compile_and_run, tasks, max_workers)
+
+        # apply results
+        units_with_inputs = [unit_with_input
+                             for task in tasks
+                             for unit_with_input in task]
+        statuses = [status
+                    for statuses_of_task in statuses_of_tasks
+                    for status in statuses_of_task]
+        for (unit, input), status in zip(units_with_inputs, statuses):
+            maybe_compilation_status, maybe_running_status = status
+            if maybe_compilation_status:
+                output, error_output, killed, execution_time = \
+                  maybe_compilation_status
+                compilation_status = CompilationStatus( \
+                  output, error_output, killed, execution_time)
+                unit.maybe_last_compilation_status = compilation_status
+            if maybe_running_status:
+                output, error_output, killed, execution_time = \
+                  maybe_running_status
+                running_status = RunStatus(input, output, error_output,
+                                           killed, execution_time)
+                unit.maybe_run_status = running_status
+            else:
+                unit.maybe_run_status = None
+
+        if not self.keep_run_inputs:
+            for unit in self.units_by_IDs.itervalues():
+                if unit.maybe_run_status is not None:
+                    unit.maybe_run_status = \
+                      unit.maybe_run_status._replace(input=None)
+
     @log_on_enter('analising outputs', mode='time')
     def _analise_outputs(self):
         for unit in self.units_by_IDs.itervalues():
@@ -296,15 +411,19 @@ class Game(object):
         units_IDs = self.units_by_IDs.keys()
         random.shuffle(units_IDs)
 
-        for unit_ID in units_IDs:
-            unit = self.units_by_IDs.get(unit_ID, None)
+        self._flow_fields_by_destinations = {}
+        try:
+            for unit_ID in units_IDs:
+                unit = self.units_by_IDs.get(unit_ID, None)
 
-            # unit can be destroyed by another unit
-            if not unit:
-                continue
+                # unit can be destroyed by another unit
+                if not unit:
+                    continue
 
-            unit.action = self._generate_action_for(unit)
-            self._execute_action_for(unit)
+                unit.action = self._generate_action_for(unit)
+                self._execute_action_for(unit)
+        finally:
+            del self._flow_fields_by_destinations
 
     def _send_message(self, message):
         is_valid_ID = lambda ID: ID in self.units_by_IDs or ID == 0
@@ -386,44 +505,14 @@ class Game(object):
                         % input_data_dict)
 
         # info about surroundings
-        def generate_input_for_field(x, y):
-            # out of map?
-            if not self.game_map[x, y].valid_position:
-                return '1 0 0'
-
-            # not out of map
-            field = self.game_map[x, y]
-
-            obj = field.maybe_object
-            if field.empty:
-                return '0 0 0'
-
-            elif isinstance(obj, MineralDeposit):
-                minerals = obj.minerals
-                return '2 %d 0' % minerals
-
-            elif isinstance(obj, Tree):
-                return '3 0 0'
-
-            else:
-                assert isinstance(obj, Unit)
-
-                unit = obj
-                unit_type = unit.type.main_name
-                player_ID = unit.player.ID
-                return '%s %d %d' % (unit_type, unit.ID, player_ID)
-
-
-        min_x = unit.position[0] - unit.type.vision_radius
-        max_x = unit.position[0] + unit.type.vision_radius
-        min_y = unit.position[1] - unit.type.vision_radius
-        max_y = unit.position[1] + unit.type.vision_radius
-        input_data += '\n'.join(map(
-            ' '.join,
-            [   [   generate_input_for_field(x, y)
-                for x in xrange(min_x, max_x+1)]
-            for y in xrange(min_y, max_y+1)]
-        ))
+        if self._input_layer is None:
+            self._input_layer = _InputLayer()
+        self._input_layer.update(self.game_map)
+        radius = unit.type.vision_radius
+        x, y = unit.position
+        input_data += self._input_layer.view(x-radius, y-radius,
+                                             x+radius, y+radius,
+                                             key=unit.ID)
         input_data += '\n'
 
         # messages
@@ -435,26 +524,10 @@ class Game(object):
     @log_on_enter('find nearest unit in range', mode='only time')
     def find_nearest_unit_in_range_fulfilling_condition(self, center,
                                                         range, condition):
-        def positions_in_range(center, range):
-            for x in xrange(center[0]-range,
-                            center[0]+range+1):
-                for y in xrange(center[1]-range,
-                                center[1]+range+1):
-                    if distance((x, y), center) <= range:
-                        yield x, y
-
-        fields = (self.game_map[pos] for pos
-                  in positions_in_range(center, range))
-        objs = (field.maybe_object for field
-                in fields if not field.empty)
-        units_fulfilling_condition = list(
-            obj for obj in objs
-            if isinstance(obj, Unit) and condition(obj))
-        if not units_fulfilling_condition:
-            return None
+        """ Ties are broken by x and then by y coordinate. """
 
-        return min(units_fulfilling_condition,
-                   key=lambda unit: distance(center, unit.position))
+        return self.game_map.find_nearest_object_of_type(center, range,
+                                                         Unit, condition)
 
     def _generate_action_for(self, unit):
         command_type = type(unit.command)
@@ -641,7 +714,7 @@ class Game(object):
     def _find_path_and_generate_action(self, unit, goal=None):
         source = unit.position
         goal = goal or unit.command.destination
-        maybe_direction = self.game_map.find_direction(source, goal)
+        maybe_direction = self._find_direction(source, goal, unit.ID)
         if not maybe_direction:
             return actions.StopAction()
 
@@ -651,6 +724,40 @@ class Game(object):
         return actions.MoveAction(source=unit.position,
                                   destination=destination)
 
+    def _find_direction(self, source, goal, unit_ID):
+        """ Paths found by A* (or with the cluster graph if they're long)
+        are remembered for units, so they're reused in the next turns. The
+        first unit going to a goal in a turn finds its path. Next ones share
+        flow field of the goal unless they have path to it. When the flow
+        field is out of date (e.g. its best step is blocked by a unit that
+        moved there), the path is searched as usual. """
+
+        if self._path_cache is None:
+            self._path_cache = PathCache(ClusterGraph(ignored_types=(Unit,)))
+        valid_goal = self.game_map.is_valid_position(goal)
+        if (valid_goal and
+            not self._path_cache.cluster_graph.are_connected(
+                self.game_map, source, goal)):
+            return None
+        find_path_with_a_star = lambda: self._path_cache.find_direction(
+            self.game_map, unit_ID, source, goal)
+
+        flow_fields = self._flow_fields_by_destinations
+        if (flow_fields is None or not valid_goal or
+            self._path_cache.has_path(unit_ID, goal)):
+            return find_path_with_a_star()
+
+        if goal not in flow_fields:
+            flow_fields[goal] = None
+            return find_path_with_a_star()
+
+        if flow_fields[goal] is None:
+            flow_fields[goal] = FlowField(self.game_map, goal)
+        maybe_direction = flow_fields[goal].find_direction(source)
+        if maybe_direction is FlowField.UNKNOWN:
+            return find_path_with_a_star()
+        return maybe_direction
+
     def _execute_action_for(self, unit):
         action_type = type(unit.action)
 
@@ -696,14 +803,175 @@ class Game(object):
 
     @log_on_enter('tic for world', mode='time')
     def _tic_for_world(self):
-        for x in xrange(self.game_map.size[0]):
-            for y in xrange(self.game_map.size[1]):
-                if (isinstance(self.game_map[x, y].maybe_object,
-                               MineralDeposit) and
-                    random.random() < \
-                    self.configuration.probability_of_mineral_deposit_growing):
-                    mineral_deposit = self.game_map[x, y].maybe_object
-                    mineral_deposit.minerals += 1
+        # the same order of drawing random numbers as in column-by-column scan
+        mineral_deposits = sorted(
+            self.game_map.objects_of_type(MineralDeposit),
+            key=lambda (position, obj): position)
+        probability = self.configuration.probability_of_mineral_deposit_growing
+        draws = [random.random() for _ in mineral_deposits]
+        for (position, mineral_deposit), draw in zip(mineral_deposits, draws):
+            if draw < probability:
+                mineral_deposit.minerals += 1
+                self.game_map.mark_changed(position)
+
+
+class RenderSnapshot(object):
+    """ Read-only state of game needed to draw it. It doesn't refer to
+    any mutable object of the game, so it can be read while the game is
+    changed by another thread. Units are described by parallel lists
+    sorted by units IDs. """
+
+    __slots__ = ('size', 'ground_types', 'trees', 'mineral_deposits',
+                 'unit_IDs', 'unit_positions', 'unit_type_names',
+                 'unit_directions', 'unit_minerals', 'unit_player_IDs',
+                 'unit_actions', 'players')
+
+    def __init__(self, game):
+        game_map = game.game_map
+        self.size = game_map.size
+        self.ground_types = game_map.ground_types()
+        # lists of pairs (position, tree type) and (position, minerals)
+        self.trees = [(position, tree.type) for position, tree
+                      in game_map.objects_of_type(Tree)]
+        self.mineral_deposits = [(position, deposit.minerals)
+                                 for position, deposit
+                                 in game_map.objects_of_type(MineralDeposit)]
+
+        units = [game.units_by_IDs[ID] for ID in sorted(game.units_by_IDs)]
+        self.unit_IDs = [unit.ID for unit in units]
+        self.unit_positions = [unit.position for unit in units]
+        self.unit_type_names = [unit.type.main_name for unit in units]
+        self.unit_directions = [unit.direction for unit in units]
+        self.unit_minerals = [unit.minerals for unit in units]
+        self.unit_player_IDs = [unit.player.ID for unit in units]
+        self.unit_actions = [unit.action for unit in units]
+        # dict {player ID : (name, color)}
+        self.players = dict((player.ID, (player.name, player.color))
+                            for player in game.players_by_IDs.itervalues())
+
+    def is_valid_position(self, position):
+        return (0 <= position[0] < self.size[0] and
+                0 <= position[1] < self.size[1])
+
+    def ground_type_at(self, x, y):
+        """ Return 0 for positions outside map. """
+
+        if not self.is_valid_position((x, y)):
+            return 0
+        return self.ground_types[y*self.size[0] + x]
+
+
+class _InputLayer(object):
+    """ Descriptions of all fields of map as they appear in inputs of
+    programs. They're updated incrementally using change journal of the
+    map, so each field is described once per change. Lines of views are
+    cached too, so only lines of changed rows are joined again. """
+
+    OUTSIDE_MAP = '1 0 0'
+    # generation of rows outside map, which never change
+    OUTSIDE_MAP_GENERATION = -1
+
+    def __init__(self):
+        self._rows = None # list of rows; row is list of descriptions
+        self._mark = None
+        # self._generations[y] is generation of the last update of row y
+        self._generations = None
+        self._generation = 0
+        # self._views is dict {key : (rectangle, generations, lines)}
+        self._views = {}
+
+    def __deepcopy__(self, memo):
+        result = _InputLayer()
+        if self._rows is not None:
+            result._rows = [list(row) for row in self._rows]
+            result._generations = list(self._generations)
+        result._mark = self._mark
+        result._generation = self._generation
+        result._views = dict((key, (rectangle, list(generations), list(lines)))
+                             for key, (rectangle, generations, lines)
+                             in self._views.iteritems())
+        memo[id(self)] = result
+        return result
+
+    def update(self, game_map):
+        changes = None
+        if self._rows is not None:
+            changes = game_map.changed_since(self._mark)
+        if changes is None:
+            width, height = game_map.size
+            self._rows = [map(_describe_object,
+                              game_map.objects_in_row(y, 0, width))
+                          for y in xrange(height)]
+            self._generation += 1
+            self._generations = [self._generation] * height
+        elif changes:
+            self._generation += 1
+            for x, y in changes:
+                self._rows[y][x] = _describe_object(game_map.object_at(x, y))
+                self._generations[y] = self._generation
+        self._mark = game_map.change_mark()
+
+    def view(self, min_x, min_y, max_x, max_y, key=None):
+        """ Return lines describing fields in rectangle (boundaries
+        included). If key is given, the lines are cached and the next call
+        with the same key and rectangle joins only lines of changed
+        rows. """
+
+        rectangle = (min_x, min_y, max_x, max_y)
+        view = self._views.get(key, None) if key is not None else None
+        if view is None or view[0] != rectangle:
+            view = (rectangle,
+                    [None] * (max_y-min_y+1),
+                    [None] * (max_y-min_y+1))
+            if key is not None:
+                self._views[key] = view
+        _, generations, lines = view
+
+        height, width = len(self._rows), len(self._rows[0])
+        left = [_InputLayer.OUTSIDE_MAP] * max(0, min(-min_x, max_x-min_x+1))
+        right = [_InputLayer.OUTSIDE_MAP] * \
+                max(0, min(max_x-width+1, max_x-min_x+1))
+        start, stop = max(0, min_x), min(width, max_x+1)
+        for i, y in enumerate(xrange(min_y, max_y+1)):
+            if 0 <= y < height:
+                generation = self._generations[y]
+                if generations[i] != generation:
+                    lines[i] = ' '.join(left + self._rows[y][start:stop] +
+                                        right)
+            else:
+                generation = _InputLayer.OUTSIDE_MAP_GENERATION
+                if generations[i] != generation:
+                    lines[i] = ' '.join([_InputLayer.OUTSIDE_MAP] *
+                                        (max_x-min_x+1))
+            generations[i] = generation
+        return '\n'.join(lines)
+
+    def forget(self, key):
+        """ Remove cached lines of view with the key. """
+
+        self._views.pop(key, None)
+
+
+def _split_into_chunks(items, count):
+    """ Split list into at most count lists of similar lengths. """
+
+    chunk_size = (len(items) + count - 1) // count
+    return [items[i:i+chunk_size] for i in xrange(0, len(items), chunk_size)]
+
+
+def _describe_object(obj):
+    if obj is None:
+        return '0 0 0'
+
+    elif isinstance(obj, MineralDeposit):
+        return '2 %d 0' % obj.minerals
+
+    elif isinstance(obj, Tree):
+        return '3 0 0'
+
+    else:
+        assert isinstance(obj, Unit)
+        return '%s %d %d' % (obj.type.main_name, obj.ID, obj.player.ID)
 
 
 class MineralDeposit(object):
@@ -748,6 +1016,14 @@ class Tree(object):
 
 
 class Unit(object):
+    # attributes which values are immutable, so they're shared by copies
+    _IMMUTABLE_ATTRIBUTES = ('direction', 'program',
+                             'maybe_last_compilation_status',
+                             'maybe_run_status', 'command', 'action',
+                             'position', 'ID', '_minerals')
+    __slots__ = _IMMUTABLE_ATTRIBUTES + ('player', 'type', 'outbox',
+                                         'inbox', 'outbox_queue')
+
     def __init__(self, player, type, position, ID):
         self.direction = direction.N
         self.program = None
@@ -762,6 +1038,28 @@ class Unit(object):
         self._minerals = 0
         self.outbox = []
         self.inbox = []
+        self.outbox_queue = []
+
+    def __deepcopy__(self, memo):
+        result = Unit.__new__(Unit)
+        memo[id(self)] = result
+        for name in Unit._IMMUTABLE_ATTRIBUTES:
+            setattr(result, name, getattr(self, name))
+        result.player = deepcopy(self.player, memo)
+        result.type = deepcopy(self.type, memo)
+        result.outbox = list(self.outbox)
+        result.inbox = list(self.inbox)
+        result.outbox_queue = list(self.outbox_queue)
+        return result
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in Unit.__slots__)
+
+    def __setstate__(self, state):
+        # units pickled by older versions may not have outbox_queue
+        self.outbox_queue = []
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     @ property
     def minerals(self):
@@ -945,6 +1243,9 @@ DEFAULT_GAME_CONFIGURATION = GameConfiguration(
 
 
 class Player(object):
+    __slots__ = ('name', 'color', 'ID', 'units', 'maybe_base',
+                 'start_position')
+
     def __init__(self, name, color, ID, start_position):
         self.name = name
         self.color = color
@@ -953,6 +1254,20 @@ class Player(object):
         self.maybe_base = None
         self.start_position = start_position
 
+    def __deepcopy__(self, memo):
+        result = Player(self.name, self.color, self.ID, self.start_position)
+        memo[id(self)] = result
+        result.units = deepcopy(self.units, memo)
+        result.maybe_base = deepcopy(self.maybe_base, memo)
+        return result
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in Player.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def add_unit(self, unit):
         unit.player = self
         self.units.append(unit)
@@ -24,6 +24,7 @@ from collections import defaultdict
 from functools import partial, wraps
 import logging
 import logging.handlers
+import threading
 import time as time_module
 
 
@@ -38,10 +39,19 @@ LOG_FILENAME = '.scriptcraft.log'
 _initialisated = False
 
 
+class _ThreadState(threading.local):
+    # timed code may be executed concurrently, so every thread has its
+    # own indentation of log messages
+    indent_depth = 0
+
+_thread_state = _ThreadState()
+_timing_data_lock = threading.Lock()
+
+
 def init_logging(lvl='info'):
     """ Init logging. Log in file and on console."""
-    global _indent_depth, _timing_data, _initialisated
-    _indent_depth = 0
+    global _timing_data, _initialisated
+    _thread_state.indent_depth = 0
 
     lvl = _validate_level(lvl)
     if lvl == logging.DEBUG:
@@ -112,32 +122,36 @@ def log_on_enter(msg, lvl='debug', mode='log'):
 
     class result(object):
         def __enter__(self): # context manager use case
-            global _indent_depth, _initialisated
+            global _initialisated
             if _initialisated:
                 if log_this:
                     _log(level, msg)
-                    _indent_depth += 1
+                    _thread_state.indent_depth += 1
                 if time:
                     self.started_time = time_module.time()
 
         def __exit__(self, *args): # context manager use case
             # args is [type, value, traceback] or []
-            global _indent_depth, _timing_data, _initialisated
+            global _timing_data, _initialisated
             if _initialisated:
                 if _timing_data is not None and time:
                     delta_time = (time_module.time() - self.started_time) * 1000
-                    _timing_data[msg].append(delta_time)
+                    with _timing_data_lock:
+                        _timing_data[msg].append(delta_time)
                 if log_this:
-                    _indent_depth -= 1
+                    _thread_state.indent_depth -= 1
 
         def __call__(self, f): # decorator use case
             @ wraps(f)
             def wraper(*args, **kwargs):
-                self.__enter__()
+                # Decorated function may be called concurrently from many
+                # threads, so each call needs its own started_time.
+                context = result()
+                context.__enter__()
                 try:
                     return f(*args, **kwargs)
                 finally:
-                    self.__exit__()
+                    context.__exit__()
             return wraper
 
     return result()
@@ -152,7 +166,9 @@ def shutdown_logging():
     if _timing_data is not None:
         log('TIMING INFO')
         log('%5s %8s  %6s   %6s   %6s    %s' % ('calls', 'total', 'avg', 'min', 'max', 'title'))
-        for key, times in sorted(_timing_data.items()):
+        with _timing_data_lock:
+            timing_data = sorted(_timing_data.items())
+        for key, times in timing_data:
             calls = len(times)
             total = sum(times)/1000
             average = sum(times)/len(times)
@@ -164,8 +180,7 @@ def shutdown_logging():
 
 
 def _log(lvl, msg, category=''):
-    global _indent_depth
-    msg = (LOG_INDENT_PATTERN*_indent_depth) + msg
+    msg = (LOG_INDENT_PATTERN*_thread_state.indent_depth) + msg
     logging.log(lvl, msg)
 
 
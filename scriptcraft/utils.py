@@ -16,6 +16,7 @@ __all__ = [
     'memoized',
     'on_error_do',
     'on_error_return',
+    'parallel_map',
     'record',
     'skip',
     'shutdown_logging',
@@ -27,6 +28,7 @@ from collections import namedtuple
 import copy
 from functools import partial, wraps
 import inspect
+from multiprocessing.pool import ThreadPool
 import os, sys, shutil
 import pkg_resources
 import time
@@ -87,6 +89,26 @@ def on_error_do(errors, function):
     return inner
 
 
+def parallel_map(function, iterable, max_workers=1):
+    """ Like map(function, iterable), but at most max_workers calls are
+    executed concurrently by a pool of threads. The order of the result list
+    is the order of items in iterable, no matter in which order the calls
+    finished. If max_workers is 1, no thread is created.
+
+    The first exception raised by any call is reraised. """
+
+    items = list(iterable)
+    if max_workers <= 1 or len(items) <= 1:
+        return map(function, items)
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def datafile_path(relative_path):
     """ Return valid path to datafile. The root directory for given
     relative path should be main scriptcraft directory. An example of
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import random
+import unittest
+
+try:
+    from scriptcraft import client
+except ImportError: # no Tkinter or PIL
+    client = None
+from scriptcraft.gamemap import GameMap
+from scriptcraft.gamestate import (cmds, Game, DEFAULT_GAME_CONFIGURATION,
+                                   MineralDeposit, RenderSnapshot, Tree)
+from scriptcraft.utils import *
+
+
+
+class FakeCanvas:
+    """ Records items instead of drawing them. Supports only these Canvas
+    methods which are used by GameViewer to draw a game. Items are kept
+    in stacking order (the lowest one first). """
+
+    def _init_items(self):
+        self.items = {} # id -> [tags, coords, options]
+        self.stacking_order = []
+        self.operations = 0
+        self._next_id = 1
+
+    def _create(self, coords, options):
+        tags = options.pop('tags', [])
+        if isinstance(tags, basestring):
+            tags = [tags]
+        item_id = self._next_id
+        self._next_id += 1
+        self.items[item_id] = [list(tags), tuple(coords), options]
+        self.stacking_order.append(item_id)
+        self.operations += 1
+        return item_id
+
+    def create_image(self, *coords, **options):
+        return self._create(coords, options)
+
+    def create_text(self, *coords, **options):
+        return self._create(coords, options)
+
+    def create_line(self, *coords, **options):
+        return self._create(coords, options)
+
+    def create_polygon(self, *coords, **options):
+        return self._create(coords, options)
+
+    def _find(self, tag_or_id):
+        if isinstance(tag_or_id, (int, long)):
+            return [tag_or_id] if tag_or_id in self.items else []
+        return [item_id for item_id in self.stacking_order
+                if tag_or_id in self.items[item_id][0]]
+
+    def delete(self, *tags_or_ids):
+        for tag_or_id in tags_or_ids:
+            for item_id in self._find(tag_or_id):
+                del self.items[item_id]
+                self.stacking_order.remove(item_id)
+                self.operations += 1
+
+    def coords(self, tag_or_id, *coords):
+        for item_id in self._find(tag_or_id):
+            self.items[item_id][1] = tuple(coords)
+        self.operations += 1
+
+    def itemconfigure(self, tag_or_id, **options):
+        for item_id in self._find(tag_or_id):
+            self.items[item_id][2].update(options)
+        self.operations += 1
+
+    itemconfig = itemconfigure
+
+    def dtag(self, tag_or_id, tag):
+        for item_id in self._find(tag_or_id):
+            self.items[item_id][0] = [t for t in self.items[item_id][0]
+                                      if t != tag]
+
+    def addtag_withtag(self, new_tag, tag_or_id):
+        for item_id in self._find(tag_or_id):
+            self.items[item_id][0].append(new_tag)
+
+    def tag_raise(self, tag_or_id, above=None):
+        moved = self._find(tag_or_id)
+        rest = [i for i in self.stacking_order if i not in moved]
+        if above is None:
+            self.stacking_order = rest + moved
+            return
+        anchors = [rest.index(i) for i in self._find(above) if i in rest]
+        if moved and anchors:
+            top = max(anchors) + 1
+            self.stacking_order = rest[:top] + moved + rest[top:]
+
+    def tag_lower(self, tag_or_id, below=None):
+        moved = self._find(tag_or_id)
+        rest = [i for i in self.stacking_order if i not in moved]
+        anchors = [rest.index(i) for i in self._find(below) if i in rest] \
+                  if below is not None else [0]
+        bottom = min(anchors) if anchors else 0
+        self.stacking_order = rest[:bottom] + moved + rest[bottom:]
+
+    def event_generate(self, *args, **kwargs):
+        pass
+
+    def picture(self):
+        """ Return drawn items (without their ids) in stacking order. """
+
+        return [(sorted(self.items[i][0]), self.items[i][1],
+                 self.items[i][2].get('image'), self.items[i][2].get('text'))
+                for i in self.stacking_order]
+
+
+if client is not None:
+    class HeadlessGameViewer(FakeCanvas, client.GameViewer):
+        """ GameViewer without Tk window. Sprites and fonts are replaced by
+        their names and the ground image is never computed. """
+
+        def __init__(self):
+            self._init_items()
+            self._zoom = 1.0
+            self._delta = (-5.0, 0.0)
+            self._snapshot = None
+            self._scaled_images_cache = {}
+            self._ground_image_cache = None
+            self._ground_tiles_cache = {}
+            self._last_mouse_position = None
+            self._click_position = None
+            self.selection_position = None
+            self._drawn_objects = {}
+            self._drawn_actions_by_IDs = {}
+            self._compute_ground_image_flag = True
+            self._loading_indicator_id = self.create_image(
+                0, 0, tags=['interface'])
+
+        def _get_scaled_sprite(self, name):
+            return name
+
+        def _get_font_for_current_zoom(self):
+            return 'font'
+
+
+@unittest.skipIf(client is None, 'Tkinter or PIL is not available')
+class TestRedrawingGame(unittest.TestCase):
+    """ Games are simulated with random commands. After each turn the game
+    redrawn by a viewer must look the same as drawn from scratch. """
+
+    SIZE = 24
+
+    def _create_game(self):
+        game_map = GameMap((self.SIZE, self.SIZE), [(5, 5), (18, 18)])
+        for _ in xrange(80):
+            position = (self._random.randrange(self.SIZE),
+                        self._random.randrange(self.SIZE))
+            near_start = any(distance(position, start) <= 2
+                             for start in [(5, 5), (18, 18)])
+            if game_map.is_accessible(*position) and not near_start:
+                obj = (Tree() if self._random.random() < 0.8
+                       else MineralDeposit(3))
+                game_map[position].place_object(obj)
+        game = Game(game_map, DEFAULT_GAME_CONFIGURATION)
+        game.new_player_with_units('Alice', (255, 0, 0))
+        game.new_player_with_units('Bob', (0, 0, 255))
+        return game
+
+    def _random_command(self, game, unit):
+        name = unit.type.main_name
+        chance = self._random.random()
+        if name == '4':
+            if chance < 0.3:
+                return cmds.BuildCommand(
+                    unit_type_name=self._random.choice(['5', '6']))
+            return cmds.StopCommand()
+        if name == '6' and chance < 0.5:
+            x, y = unit.position
+            destination = (x + self._random.randint(-3, 3),
+                           y + self._random.randint(-3, 3))
+            return cmds.FireCommand(destination=destination)
+        if name == '5' and chance < 0.3:
+            deposits = list(game.game_map.objects_of_type(MineralDeposit))
+            if deposits:
+                destination = self._random.choice(deposits)[0]
+                return cmds.ComplexGatherCommand(destination=destination)
+        destination = (self._random.randrange(self.SIZE),
+                       self._random.randrange(self.SIZE))
+        return cmds.ComplexMoveCommand(destination=destination)
+
+    def _next_turn(self, game):
+        game = game.fork()
+        game._tic_for_world()
+        for unit in game.units_by_IDs.itervalues():
+            unit.command = self._random_command(game, unit)
+        game._execute_commands()
+        return game
+
+    def _check_bookkeeping(self, viewer, snapshot):
+        expected_keys = set(
+            [('tree', position) for position, _ in snapshot.trees] +
+            [('minerals', position)
+             for position, _ in snapshot.mineral_deposits] +
+            [('unit', ID) for ID in snapshot.unit_IDs])
+        self.assertEqual(set(viewer._drawn_objects), expected_keys)
+        for _, _, sprite_id, label_id in viewer._drawn_objects.itervalues():
+            self.assertTrue(sprite_id in viewer.items)
+            self.assertTrue(label_id is None or label_id in viewer.items)
+        for ID, (_, item_ids) in viewer._drawn_actions_by_IDs.iteritems():
+            self.assertTrue(ID in snapshot.unit_IDs)
+            self.assertTrue(all(i in viewer.items for i in item_ids))
+
+    def test_redrawing_is_same_as_drawing_from_scratch(self):
+        for seed in xrange(3):
+            self._random = random.Random(seed)
+            game = self._create_game()
+            viewer = HeadlessGameViewer()
+            viewer.set_game(RenderSnapshot(game))
+            for turn in xrange(30):
+                game = self._next_turn(game)
+                snapshot = RenderSnapshot(game)
+                operations_before = viewer.operations
+                viewer.set_game(snapshot)
+                redrawing_operations = viewer.operations - operations_before
+                fresh_viewer = HeadlessGameViewer()
+                fresh_viewer.set_game(snapshot)
+
+                self.assertEqual(viewer.picture(), fresh_viewer.picture())
+                self._check_bookkeeping(viewer, snapshot)
+                self.assertTrue(redrawing_operations <=
+                                fresh_viewer.operations)
+
+    def test_forgetting_game(self):
+        self._random = random.Random(0)
+        game = self._create_game()
+        viewer = HeadlessGameViewer()
+        viewer.set_game(RenderSnapshot(game))
+        viewer.set_game(RenderSnapshot(self._next_turn(game)))
+
+        viewer.set_game(None)
+
+        self.assertEqual(viewer._drawn_objects, {})
+        self.assertEqual(viewer._drawn_actions_by_IDs, {})
+        self.assertEqual(viewer._find('object'), [])
+        self.assertEqual(viewer._find('action'), [])
+        self.assertEqual(viewer._find('static'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
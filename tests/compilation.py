@@ -2,10 +2,12 @@
 #-*- coding:utf-8 -*-
 
 import os
+import sys
 import unittest
 import time
 
-from scriptcraft.compilation import Environment, CompileAndRunProgram
+from scriptcraft.compilation import (Environment, CompileAndRunProgram,
+                                     CompileCache, PythonWorkerPool)
 from scriptcraft.gamestate import Language
 from scriptcraft.utils import *
 
@@ -80,12 +82,233 @@ class TestBasic(unittest.TestCase):
         self.assertFalse(killed)
         self.assertTrue(0 < elapsed_time)
 
-    def _build_compile_and_run_program_instance(self):
+    def test_concurrent_calls(self):
+        program_code = self._build_echo_cpp_code()
+        inputs = ['input number %d' % i for i in xrange(8)]
+
+        compile_and_run = self._build_compile_and_run_program_instance()
+        call = lambda input_data: compile_and_run(Language.CPP,
+                                                  program_code,
+                                                  input_data)
+        statuses = parallel_map(call, inputs, max_workers=4)
+
+        compilation_statuses = [compilation_status
+                                for compilation_status, _ in statuses
+                                if compilation_status is not None]
+        self.assertEqual(len(compilation_statuses), 1)
+        outputs = [running_status[0] for _, running_status in statuses]
+        self.assertEqual(outputs, inputs)
+
+    def test_sandboxes_are_reused(self):
+        program_code = self._build_echo_cpp_code()
+
+        compile_and_run = self._build_compile_and_run_program_instance()
+        for i in xrange(3):
+            compile_and_run(Language.CPP, program_code, 'input')
+
+        sandboxes = os.listdir(os.path.join(self.directory, 'env'))
+        self.assertEqual(sandboxes, ['0'])
+
+    def test_binary_is_executed_in_place(self):
+        program_code = self._build_echo_cpp_code()
+
+        compile_and_run = self._build_compile_and_run_program_instance()
+        for i in xrange(2):
+            compilation_status, running_status = \
+                compile_and_run(Language.CPP, program_code, 'input')
+
+        self.assertEqual(running_status[0], 'input')
+        sandbox = os.path.join(self.directory, 'env', '0')
+        self.assertEqual(os.listdir(sandbox), [])
+
+    def test_running_command_using_shell(self):
+        program_code = self._build_echo_cpp_code()
+
+        compile_and_run = CompileAndRunProgram(
+            self.directory,
+            {Language.CPP:'src.cpp'},
+            {Language.CPP:'bin.exe'},
+            {Language.CPP:'g++ src.cpp -o bin.exe'},
+            {Language.CPP:'./bin.exe | ./bin.exe'})
+        compilation_status, running_status = \
+            compile_and_run(Language.CPP, program_code, 'input')
+
+        self.assertEqual(running_status[0], 'input')
+
+    def test_output_of_deterministic_program_is_memoized(self):
+        program_code = ('// %s\n' %
+                        CompileAndRunProgram.DETERMINISTIC_PROGRAM_MARKER +
+                        self._build_pid_printing_cpp_code())
+
+        compile_and_run = self._build_compile_and_run_program_instance(
+            max_memoized_outputs=16)
+        _, first_running_status = compile_and_run(Language.CPP,
+                                                  program_code, 'input')
+        _, second_running_status = compile_and_run(Language.CPP,
+                                                   program_code, 'input')
+        _, third_running_status = compile_and_run(Language.CPP,
+                                                  program_code, 'other')
+
+        self.assertEqual(first_running_status, second_running_status)
+        self.assertNotEqual(first_running_status[0],
+                            third_running_status[0])
+
+    def test_output_of_nondeterministic_program_is_not_memoized(self):
+        program_code = self._build_pid_printing_cpp_code()
+
+        compile_and_run = self._build_compile_and_run_program_instance(
+            max_memoized_outputs=16)
+        _, first_running_status = compile_and_run(Language.CPP,
+                                                  program_code, 'input')
+        _, second_running_status = compile_and_run(Language.CPP,
+                                                   program_code, 'input')
+
+        self.assertNotEqual(first_running_status[0],
+                            second_running_status[0])
+
+    def test_invalid_program_is_not_compiled_again(self):
+        compile_and_run = self._build_compile_and_run_program_instance()
+        first_status = compile_and_run(Language.CPP, '', '')
+        second_status = compile_and_run(Language.CPP, '', '')
+
+        # the status of the first compilation is returned again
+        self.assertEqual(first_status, second_status)
+        self.assertEqual(compile_and_run.compile_cache.statistics()['hits'], 1)
+
+    def test_compilation_in_background(self):
+        program_code = self._build_valid_cpp_code()
+
+        compile_and_run = self._build_compile_and_run_program_instance()
+        compile_and_run.compile_in_background(Language.CPP, program_code)
+        first_status = compile_and_run(Language.CPP, program_code, '')
+        second_status = compile_and_run(Language.CPP, program_code, '')
+
+        # the status is returned once
+        self.assertEqual(first_status[0][1:3], ('', False))
+        self.assertEqual(second_status[0], None)
+        self.assertEqual(first_status[1][0], 'tekst outputowy\nala')
+
+    def test_pending_compilation_statuses_are_limited(self):
+        old_limit = CompileAndRunProgram.MAX_PENDING_COMPILATION_STATUSES
+        CompileAndRunProgram.MAX_PENDING_COMPILATION_STATUSES = 1
+        try:
+            compile_and_run = self._build_compile_and_run_program_instance()
+            jobs = [compile_and_run._build_job(
+                        Language.CPP,
+                        self._build_valid_cpp_code() + '// %d' % i, '')
+                    for i in xrange(2)]
+            for job in jobs:
+                compile_and_run._compile_in_background(job)
+        finally:
+            CompileAndRunProgram.MAX_PENDING_COMPILATION_STATUSES = old_limit
+
+        self.assertEqual(compile_and_run._pending_compilation_statuses.keys(),
+                         [jobs[1].sha])
+
+    def test_running_batch_program_for_many_inputs(self):
+        program_code = self._build_batch_cpp_code()
+        inputs = ['first', 'second', 'third']
+
+        compile_and_run = self._build_compile_and_run_program_instance()
+        self.assertTrue(compile_and_run.supports_batch(Language.CPP,
+                                                       program_code))
+        compilation_status, running_statuses = \
+            compile_and_run.run_many(Language.CPP, program_code, inputs)
+
+        self.assertEqual(compilation_status[1], '')
+        pids_and_outputs = [running_status[0].split()
+                            for running_status in running_statuses]
+        self.assertEqual([output for pid, output in pids_and_outputs], inputs)
+        pids = set(pid for pid, output in pids_and_outputs)
+        self.assertEqual(len(pids), 1) # executed once
+
+    def test_running_batch_program_which_take_too_much_time(self):
+        program_code = self._build_batch_cpp_code()
+        inputs = ['first', 'loop', 'third']
+
+        compile_and_run = self._build_compile_and_run_program_instance(
+            max_execution_time=0.2)
+        compilation_status, running_statuses = \
+            compile_and_run.run_many(Language.CPP, program_code, inputs)
+
+        outputs = [running_status[0].split()[1:]
+                   for running_status in running_statuses]
+        self.assertEqual(outputs, [['first'], [], ['third']])
+        killed = [running_status[2] for running_status in running_statuses]
+        self.assertEqual(killed, [False, True, False])
+
+    def test_restarts_of_batch_program_are_limited(self):
+        program_code = self._build_batch_cpp_code()
+        inputs = ['loop'] * (CompileAndRunProgram.MAX_BATCH_RESTARTS + 3)
+
+        compile_and_run = self._build_compile_and_run_program_instance(
+            max_execution_time=0.2)
+        compile_and_run.run_many(Language.CPP, program_code, ['first'])
+        start_time = time.time()
+        compilation_status, running_statuses = \
+            compile_and_run.run_many(Language.CPP, program_code, inputs)
+        execution_time = time.time() - start_time
+
+        self.assertEqual([running_status[0] for running_status
+                          in running_statuses], [u''] * len(inputs))
+        self.assertTrue(all(running_status[2]
+                            for running_status in running_statuses))
+        self.assertTrue(execution_time < 0.2 * (len(inputs) - 1))
+
+    def _build_batch_cpp_code(self):
+        return """
+            // %s
+            #include <stdio.h>
+            #include <string.h>
+            #include <unistd.h>
+
+            int main() {
+                int length;
+                static char data[4096], output[4200];
+                while (scanf("%%d", &length) == 1) {
+                    getchar(); // new line character
+                    fread(data, 1, length, stdin);
+                    data[length] = 0;
+                    if (strcmp(data, "loop") == 0)
+                        while (1);
+                    length = sprintf(output, "%%d %%s", (int)getpid(), data);
+                    printf("%%d\\n%%s", length, output);
+                    fflush(stdout);
+                }
+                return 0;
+            }
+        """ % CompileAndRunProgram.BATCH_PROGRAM_MARKER
+
+    def _build_pid_printing_cpp_code(self):
+        return """
+            #include <stdio.h>
+            #include <unistd.h>
+
+            int main() {
+                printf("%d", (int)getpid());
+                return 0;
+            }
+        """
+
+    def _build_echo_cpp_code(self):
+        return """
+            #include <stdio.h>
+
+            int main() {
+                int c;
+                while ((c = getchar()) != EOF)
+                    putchar(c);
+                return 0;
+            }
+        """
+
+    def _build_compile_and_run_program_instance(self, **kwargs):
         result = CompileAndRunProgram(self.directory,
                                       {Language.CPP:'src.cpp'},
                                       {Language.CPP:'bin.exe'},
                                       {Language.CPP:'g++ src.cpp -o bin.exe'},
-                                      {Language.CPP:'./bin.exe'})
+                                      {Language.CPP:'./bin.exe'},
+                                      **kwargs)
         return result
 
     def _build_valid_cpp_code(self):
@@ -101,6 +324,159 @@ class TestBasic(unittest.TestCase):
         """
 
 
+class TestCompileCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = 'tmp_unittest_compile_cache'
+        self.file_system = TemporaryFileSystem(self.directory)
+        self.env = Environment(self.directory)
+        self.file_system.write_file('binary', 'x'*100)
+
+    def tearDown(self):
+        self.file_system.delete_files_and_folders()
+
+    def test_storing_binaries_and_failures(self):
+        cache = CompileCache(self.env, 'cache')
+        cache.put_binary('a'*40, 'binary')
+        cache.put_failure('b'*40, (u'', u'error', False, 0.5))
+
+        self.assertFalse(cache.lookup('a'*40).failed)
+        self.assertEqual(cache.lookup('b'*40).compilation_status,
+                         (u'', u'error', False, 0.5))
+        self.assertEqual(cache.lookup('c'*40), None)
+        self.assertTrue(cache.is_compiled('a'*40))
+        self.assertFalse(cache.is_compiled('b'*40))
+        statistics = cache.statistics()
+        self.assertEqual((statistics['hits'], statistics['misses']), (2, 1))
+        self.assertEqual((statistics['binaries'], statistics['failures'],
+                          statistics['size']), (1, 1, 100))
+
+    def test_least_recently_used_binaries_are_removed(self):
+        cache = CompileCache(self.env, 'cache', max_size=250)
+        cache.put_binary('a'*40, 'binary')
+        cache.put_binary('b'*40, 'binary')
+        cache.lookup('a'*40)
+        cache.put_binary('c'*40, 'binary')
+
+        self.assertTrue(cache.is_compiled('a'*40))
+        self.assertFalse(cache.is_compiled('b'*40))
+        self.assertTrue(cache.is_compiled('c'*40))
+        self.assertFalse(self.env.exists_file(('cache', 'b'*40)))
+
+    def test_binaries_in_use_are_not_removed(self):
+        cache = CompileCache(self.env, 'cache', max_size=250)
+        cache.put_binary('a'*40, 'binary')
+        with cache.binary_in_use('a'*40):
+            cache.put_binary('b'*40, 'binary')
+            cache.put_binary('c'*40, 'binary')
+
+            self.assertTrue(cache.is_compiled('a'*40))
+            self.assertTrue(self.env.exists_file(('cache', 'a'*40)))
+            self.assertFalse(cache.is_compiled('b'*40))
+
+        cache.put_binary('d'*40, 'binary')
+        self.assertFalse(cache.is_compiled('a'*40))
+        self.assertFalse(self.env.exists_file(('cache', 'a'*40)))
+
+    def test_index_is_loaded(self):
+        cache = CompileCache(self.env, 'cache')
+        cache.put_binary('a'*40, 'binary')
+        cache.put_failure('b'*40, (u'', u'error', False, 0.5))
+
+        cache = CompileCache(self.env, 'cache')
+        self.assertTrue(cache.is_compiled('a'*40))
+        self.assertEqual(cache.lookup('b'*40).compilation_status,
+                         (u'', u'error', False, 0.5))
+
+    def test_binaries_without_index_are_loaded(self):
+        self.env.copy_file('binary', ('cache', 'a'*40))
+
+        cache = CompileCache(self.env, 'cache')
+        self.assertTrue(cache.is_compiled('a'*40))
+        self.assertEqual(cache.statistics()['size'], 100)
+
+
+class TestPythonWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.directory = 'tmp_unittest_python_worker_pool'
+        self.file_system = TemporaryFileSystem(self.directory)
+        self.pool = PythonWorkerPool(sys.executable, 2, self.directory)
+
+    def tearDown(self):
+        self.pool.close()
+        self.file_system.delete_files_and_folders()
+
+    def test_program_is_executed_many_times(self):
+        path = self._create_program('import sys\n'
+                                    'sys.stdout.write(sys.stdin.read())\n')
+
+        for input_data in ('first input', 'second input'):
+            output, error_output, killed, execution_time = \
+                self.pool.run(path, input_data, 1.0)
+            self.assertEqual(output, input_data)
+            self.assertEqual(error_output, '')
+            self.assertFalse(killed)
+
+    def test_program_which_take_too_much_time(self):
+        path = self._create_program('while True: pass\n')
+
+        started_time = time.time()
+        output, error_output, killed, execution_time = \
+            self.pool.run(path, '', 0.2)
+        delta_time = time.time() - started_time
+        self.assertTrue(killed)
+        self.assertTrue(delta_time < 0.5)
+
+        # the pool still works
+        path = self._create_program('print 42\n', 'valid.py')
+        output, error_output, killed, execution_time = \
+            self.pool.run(path, '', 1.0)
+        self.assertEqual(output, '42\n')
+        self.assertFalse(killed)
+
+    def test_exception_in_program(self):
+        path = self._create_program('raise ValueError("bla bla")\n')
+
+        output, error_output, killed, execution_time = \
+            self.pool.run(path, '', 1.0)
+
+        self.assertEqual(output, '')
+        self.assertTrue('ValueError: bla bla' in error_output)
+        self.assertFalse(killed)
+
+    def test_programs_are_isolated(self):
+        first_path = self._create_program(
+            'import json\n'
+            'json.marker = 42\n'
+            '__builtins__["len"] = lambda sequence: 0\n', 'first.py')
+        second_path = self._create_program(
+            'import json\n'
+            'print getattr(json, "marker", None), len("ab")\n', 'second.py')
+
+        for path in (first_path, second_path, first_path, second_path):
+            output, error_output, killed, execution_time = \
+                self.pool.run(path, '', 1.0)
+            self.assertFalse(killed)
+        self.assertEqual(output, 'None 2\n')
+
+    def test_worker_which_died(self):
+        path = self._create_program('import os\n'
+                                    'os._exit(1)\n')
+
+        output, error_output, killed, execution_time = \
+            self.pool.run(path, '', 1.0)
+        self.assertEqual((output, error_output, killed), (u'', u'', True))
+
+        # the pool still works
+        path = self._create_program('print 42\n', 'valid.py')
+        output, error_output, killed, execution_time = \
+            self.pool.run(path, '', 1.0)
+        self.assertEqual(output, '42\n')
+
+    def _create_program(self, code, file_name='program.py'):
+        self.file_system.write_file(file_name, code)
+        return os.path.abspath(os.path.join(self.directory, file_name))
+
+
 class TestEnvironment(unittest.TestCase):
     def setUp(self):
         self.main_folder = 'tmp_unittest_test_environment'
@@ -224,6 +600,26 @@ class TestEnvironment(unittest.TestCase):
         self.assertFalse(killed)
         self.assertTrue(0.0 < execution_time < 1.0)
 
+    def test_execute_bash_command_with_long_output(self):
+        # the output doesn't fit in a pipe buffer
+        command = 'yes | head -c 1000000'
+
+        output, error_output, exit_code, killed, execution_time = \
+            self.env.execute_bash_command(command, '', '', 1.0)
+
+        self.assertFalse(killed)
+        self.assertEqual(len(output), 1000000)
+
+    def test_execute_bash_command_with_too_long_output(self):
+        command = 'yes'
+
+        output, error_output, exit_code, killed, execution_time = \
+            self.env.execute_bash_command(command, '', '', 1.0,
+                                          max_output_size=1000)
+
+        self.assertTrue(killed)
+        self.assertTrue(execution_time < 1.0)
+
     def test_execute_bash_command_which_take_too_much_time(self):
         command = 'sleep 1.0'
         started_time = time.time()
@@ -2,11 +2,13 @@
 #-*- coding:utf-8 -*-
 
 import copy
+import pickle
 import unittest
 
 from scriptcraft import direction
-from scriptcraft.gamemap import (GameMap, Field, _FindPathProblem,
-                                 FieldOutsideMap, FieldIsOccupied)
+from scriptcraft.gamemap import (GameMap, Field, ClusterGraph, FlowField,
+                                 PathCache, _FindPathProblem, FieldOutsideMap,
+                                 FieldIsOccupied)
 from scriptcraft.utils import *
 
 
@@ -147,6 +149,139 @@ class TestGameMapAndField(unittest.TestCase):
         self.assertNotEqual(original._free_start_positions,
                             copied._free_start_positions)
 
+    def test_fast_access_to_fields(self):
+        game_map = GameMap((16, 12), [])
+        game_map[3, 7].place_object('object')
+        game_map[4, 7].change_ground(2)
+
+        self.assertFalse(game_map.is_accessible(3, 7))
+        self.assertTrue(game_map.is_accessible(4, 7))
+        self.assertFalse(game_map.is_accessible(-1, 7))
+        self.assertEqual(game_map.object_at(3, 7), 'object')
+        self.assertEqual(game_map.object_at(16, 7), None)
+        self.assertEqual(game_map.ground_at(4, 7), 2)
+        self.assertEqual(game_map.ground_at(4, 12),
+                         GameMap.INVALID_GROUND_TYPE)
+
+    def test_objects_in_row(self):
+        game_map = GameMap((4, 3), [])
+        game_map[0, 1].place_object('object')
+        outside = GameMap.OUTSIDE_MAP
+
+        self.assertEqual(game_map.objects_in_row(1, -2, 2),
+                         [outside, outside, 'object', None])
+        self.assertEqual(game_map.objects_in_row(1, 3, 5), [None, outside])
+        self.assertEqual(game_map.objects_in_row(3, 0, 2), [outside, outside])
+        self.assertEqual(game_map.objects_in_row(0, 5, 7), [outside, outside])
+
+    def test_iterating_over_objects(self):
+        game_map = GameMap((16, 12), [])
+        game_map[3, 7].place_object('first')
+        game_map[9, 2].place_object('second')
+        self.assertEqual(sorted(game_map.objects()),
+                         [((3, 7), 'first'), ((9, 2), 'second')])
+
+    def test_finding_objects_of_type(self):
+        class Base(object):
+            pass
+        class Derived(Base):
+            pass
+        game_map = GameMap((16, 12), [])
+        base, derived = Base(), Derived()
+        game_map[3, 7].place_object(base)
+        game_map[9, 2].place_object(derived)
+        game_map[4, 4].place_object(Base())
+        game_map[4, 4].place_object(None)
+
+        self.assertEqual(game_map.objects_of_type(Derived),
+                         [((9, 2), derived)])
+        self.assertEqual(sorted(game_map.objects_of_type(Base)),
+                         [((3, 7), base), ((9, 2), derived)])
+        copied = copy.deepcopy(game_map)
+        self.assertEqual(len(copied.objects_of_type(Base)), 2)
+
+    def test_finding_nearest_object_of_type(self):
+        game_map = GameMap((40, 40), [])
+        positions = [(5, 5), (20, 21), (21, 20), (30, 30), (23, 20)]
+        for position in positions:
+            game_map[position].place_object(position)
+        game_map[22, 22].place_object(object())
+
+        find = game_map.find_nearest_object_of_type
+        self.assertEqual(find((22, 22), 3, tuple), (20, 21))
+        self.assertEqual(find((22, 22), 3, tuple,
+                              lambda obj: obj[0] != 20), (21, 20))
+        self.assertEqual(find((22, 22), 2, tuple), None)
+        self.assertEqual(find((0, 0), 10, tuple), (5, 5))
+        self.assertEqual(find((0, 0), 9, tuple), None)
+
+        game_map[20, 21].place_object(None)
+        game_map[29, 30].place_object((29, 30))
+        copied = copy.deepcopy(game_map)
+        self.assertEqual(copied.find_nearest_object_of_type(
+            (22, 22), 3, tuple), (21, 20))
+        self.assertEqual(copied.find_nearest_object_of_type(
+            (31, 30), 1, tuple), (30, 30))
+
+    def test_change_journal(self):
+        game_map = GameMap((16, 12), [])
+        mark = game_map.change_mark()
+        game_map[3, 7].place_object('object')
+        game_map[4, 2].change_ground(2)
+        game_map.mark_changed((5, 5))
+        self.assertEqual(game_map.changed_since(mark),
+                         set([(3, 7), (4, 2), (5, 5)]))
+        self.assertEqual(game_map.changed_since(game_map.change_mark()),
+                         set())
+
+        for i in xrange(GameMap.MAX_JOURNAL_LENGTH):
+            game_map.mark_changed((0, 0))
+        self.assertEqual(game_map.changed_since(mark), None)
+
+        forgotten_mark, mark = mark, game_map.change_mark()
+        copied = pickle.loads(pickle.dumps(game_map))
+        self.assertEqual(copied.changed_since(mark), set())
+        self.assertEqual(copied.changed_since(mark-1), set([(0, 0)]))
+        self.assertEqual(copied.changed_since(forgotten_mark), None)
+
+    def test_ground_types_are_copied_on_write(self):
+        game_map = GameMap((16, 12), [])
+        game_map[3, 7].change_ground(2)
+        copied = copy.deepcopy(game_map)
+        copied[3, 7].change_ground(3)
+        game_map[4, 7].change_ground(4)
+
+        self.assertEqual(game_map[3, 7].ground_type, 2)
+        self.assertEqual(game_map[4, 7].ground_type, 4)
+        self.assertEqual(copied[3, 7].ground_type, 3)
+        self.assertEqual(copied[4, 7].ground_type, 1)
+
+    def test_pickling(self):
+        original = GameMap((16, 12), [(3, 3)])
+        original[9, 6].change_ground(2)
+        original[3, 7].place_object('object')
+        copied = pickle.loads(pickle.dumps(original, 2))
+
+        self.assertEqual(copied[9, 6].ground_type, 2)
+        self.assertEqual(copied[3, 7].maybe_object, 'object')
+        self.assertEqual(copied._free_start_positions, set([(3, 3)]))
+        self.assertEqual(copied.objects_of_type(str), [((3, 7), 'object')])
+
+    def test_unpickling_map_pickled_by_older_version(self):
+        game_map = GameMap((3, 2), [])
+        state = {
+            '_free_start_positions' : set(),
+            '_size' : (3, 2),
+            '_ground_types' : dict(((x, y), x+1)
+                                   for x in xrange(3) for y in xrange(2)),
+            '_objs' : {(2, 1) : 'object'},
+        }
+        game_map.__setstate__(state)
+
+        self.assertEqual(game_map[2, 0].ground_type, 3)
+        self.assertEqual(game_map[2, 1].maybe_object, 'object')
+        self.assertEqual(game_map[1, 1].maybe_object, None)
+
     def test_repr_on_game_map(self):
         game_map = GameMap((16, 12), [(12, 6), (6, 3)])
         expected = "GameMap(16x12, id=0x%x)" % id(game_map)
@@ -253,6 +388,12 @@ class TestFindingPath(unittest.TestCase):
         self.source = (2, 0)
         self._test_answer_equal_to(None)
 
+    def test_path_to_destination_behind_border(self):
+        self.game_map = GameMap((3, 3), ())
+        self.destination = (3, 0)
+        self.source = (1, 0)
+        self._test_answer_equal_to(direction.E)
+
     def test_skip_if_too_long_searching_time(self):
         assert _FindPathProblem.ITERATIONS_LIMIT == 256
         s = ' '*257
@@ -291,6 +432,186 @@ class TestFindingPath(unittest.TestCase):
         return self.game_map.find_direction(self.source, self.destination)
 
 
+class TestFlowField(unittest.TestCase):
+    def setUp(self):
+        s = '     \n' + \
+            ' ttt \n' + \
+            '   t \n' + \
+            ' t t \n' + \
+            ' t   '
+        self.game_map = GameMap((5, 5), ())
+        for y, line in enumerate(s.split('\n')):
+            for x, char in enumerate(line):
+                if char == 't':
+                    self.game_map[x, y].place_object(object())
+        self.flow_field = FlowField(self.game_map, (2, 2))
+
+    def test_finding_directions(self):
+        self.assertEqual(self.flow_field.find_direction((4, 4)), direction.W)
+        self.assertEqual(self.flow_field.find_direction((0, 4)), direction.N)
+        self.assertEqual(self.flow_field.find_direction((2, 2)), None)
+
+    def test_occupied_first_step(self):
+        self.game_map[0, 3].place_object(object())
+        self.assertEqual(self.flow_field.find_direction((0, 4)),
+                         FlowField.UNKNOWN)
+
+    def test_searching_on_demand(self):
+        self.assertEqual(self.flow_field.find_direction((4, 4), 1),
+                         FlowField.UNKNOWN)
+        self.assertEqual(self.flow_field.find_direction((4, 4), 100),
+                         direction.W)
+
+    def test_unreachable_source(self):
+        self.game_map[1, 2].place_object(object())
+        self.game_map[2, 3].place_object(object())
+        flow_field = FlowField(self.game_map, (2, 2))
+        self.assertEqual(flow_field.find_direction((4, 4)), FlowField.UNKNOWN)
+
+
+class TestPathCache(unittest.TestCase):
+    def setUp(self):
+        self.game_map = GameMap((8, 3), ())
+        self.path_cache = PathCache()
+
+    def test_reusing_path(self):
+        self.assertEqual(self.path_cache.find_direction(
+            self.game_map, 'unit', (0, 1), (7, 1)), direction.E)
+        path = self.path_cache._paths['unit'].path
+        self.assertEqual(self.path_cache.find_direction(
+            self.game_map, 'unit', (1, 1), (7, 1)), direction.E)
+        self.assertTrue(self.path_cache._paths['unit'].path is path)
+        self.assertTrue(self.path_cache.has_path('unit', (7, 1)))
+        self.assertFalse(self.path_cache.has_path('unit', (7, 2)))
+
+    def test_repairing_blocked_path(self):
+        self.path_cache.find_direction(self.game_map, 'unit', (0, 1), (7, 1))
+        self.game_map[4, 1].place_object(object())
+        self.assertEqual(self.path_cache.find_direction(
+            self.game_map, 'unit', (1, 1), (7, 1)), direction.E)
+        path = self.path_cache._paths['unit'].path
+        self.assertFalse((4, 1) in path)
+        self.assertEqual(path[-1], (7, 1))
+        for previous, next in zip([(1, 1)] + path, path):
+            self.assertEqual(distance(previous, next), 1)
+
+    def test_repairing_path_with_detour_going_back(self):
+        game_map = GameMap((5, 4), ())
+        for x, y in [(1, 1), (2, 1), (3, 1), (0, 3), (1, 3), (2, 3), (3, 3),
+                     (4, 3)]:
+            game_map[x, y].place_object(object())
+        self.path_cache.find_direction(game_map, 'unit', (0, 2), (4, 2))
+        game_map[2, 2].place_object(object())
+
+        # the only way around goes through the source
+        self.assertEqual(self.path_cache.find_direction(
+            game_map, 'unit', (0, 2), (4, 2)), direction.N)
+        path = self.path_cache._paths['unit'].path
+        self.assertEqual(len(set(path)), len(path))
+        self.assertFalse((0, 2) in path)
+        self.assertEqual(path[-1], (4, 2))
+        for previous, next in zip([(0, 2)] + path, path):
+            self.assertEqual(distance(previous, next), 1)
+
+    def test_forgetting_path(self):
+        self.path_cache.find_direction(self.game_map, 'unit', (0, 1), (7, 1))
+        self.path_cache.forget('unit')
+        self.assertFalse(self.path_cache.has_path('unit', (7, 1)))
+
+
+class TestClusterGraph(unittest.TestCase):
+    def setUp(self):
+        # wall with one gap at the bottom; the way around it is too long
+        # for A*
+        self.game_map = GameMap((64, 64), ())
+        for y in xrange(63):
+            self.game_map[32, y].place_object(object())
+        self.source, self.destination = (8, 8), (56, 8)
+
+    def test_finding_waypoints(self):
+        cluster_graph = ClusterGraph()
+        waypoints = cluster_graph.find_waypoints(self.game_map, self.source,
+                                                 self.destination)
+        self.assertEqual(waypoints[-1], self.destination)
+        self.assertTrue((32, 63) in waypoints)
+        for previous, next in zip([self.source] + waypoints, waypoints):
+            self.assertTrue(distance(previous, next) <=
+                            2*ClusterGraph.CLUSTER_SIZE)
+
+    def test_updating_graph(self):
+        cluster_graph = ClusterGraph()
+        self.game_map[32, 63].place_object(object())
+        self.assertEqual(cluster_graph.find_waypoints(
+            self.game_map, self.source, self.destination), None)
+        self.game_map[32, 8].place_object(None)
+        waypoints = cluster_graph.find_waypoints(self.game_map, self.source,
+                                                 self.destination)
+        self.assertTrue((32, 8) in waypoints)
+
+    def test_occupied_destination_on_border_of_clusters(self):
+        # the only free neighbour of the destination is in another cluster
+        destination = (ClusterGraph.CLUSTER_SIZE, 40)
+        for position in ((destination[0], 39), (destination[0], 41),
+                         (destination[0]+1, 40), destination):
+            self.game_map[position].place_object(object())
+        cluster_graph = ClusterGraph()
+
+        self.assertTrue(cluster_graph.are_connected(
+            self.game_map, self.source, destination))
+        waypoints = cluster_graph.find_waypoints(self.game_map, self.source,
+                                                 destination)
+        self.assertEqual(waypoints[-1], destination)
+
+        path_cache = PathCache(cluster_graph)
+        position = self.source
+        for _ in xrange(100):
+            maybe_direction = path_cache.find_direction(
+                self.game_map, 'unit', position, destination)
+            if maybe_direction is None:
+                break
+            dx, dy = direction.TO_RAY[maybe_direction]
+            position = (position[0] + dx, position[1] + dy)
+        self.assertEqual(position, (destination[0]-1, 40))
+
+    def test_ignored_types(self):
+        class Movable(object):
+            pass
+
+        self.game_map[32, 63].place_object(Movable())
+        self.assertEqual(ClusterGraph().find_waypoints(
+            self.game_map, self.source, self.destination), None)
+        self.assertNotEqual(ClusterGraph((Movable,)).find_waypoints(
+            self.game_map, self.source, self.destination), None)
+
+    def test_connected_components(self):
+        cluster_graph = ClusterGraph()
+        self.assertTrue(cluster_graph.are_connected(
+            self.game_map, self.source, self.destination))
+        self.game_map[32, 63].place_object(object())
+        self.assertFalse(cluster_graph.are_connected(
+            self.game_map, self.source, self.destination))
+        self.assertTrue(cluster_graph.are_connected(
+            self.game_map, self.source, (32, 8)))
+        self.game_map[32, 63].place_object(None)
+        self.assertTrue(cluster_graph.are_connected(
+            self.game_map, self.source, self.destination))
+
+    def test_following_long_path(self):
+        self.assertEqual(self.game_map.find_path(self.source,
+                                                 self.destination), None)
+        path_cache = PathCache(ClusterGraph())
+        position = self.source
+        for _ in xrange(200):
+            if position == self.destination:
+                break
+            maybe_direction = path_cache.find_direction(
+                self.game_map, 'unit', position, self.destination)
+            self.assertNotEqual(maybe_direction, None)
+            dx, dy = direction.TO_RAY[maybe_direction]
+            position = (position[0] + dx, position[1] + dy)
+        self.assertEqual(position, self.destination)
+
+
 class TestFindingPathEfficiency(unittest.TestCase):
     @ max_time(10)
     def test_efficiency_on_blank_map_with_non_heura_algorythm(self):
@@ -3,12 +3,14 @@
 
 import copy
 import os
+import pickle
+import random
 import unittest
 import shutil
 
 from scriptcraft import direction
 from scriptcraft.compilation import CompileAndRunProgram
-from scriptcraft.gamemap import GameMap, FieldIsOccupied
+from scriptcraft.gamemap import GameMap, FieldIsOccupied, FlowField
 from scriptcraft.gamestate import *
 from scriptcraft.utils import *
 
@@ -158,6 +160,100 @@ class TestBasic(BaseGameTestCase):
         self.assertEqual(self.base.program, program)
 
 
+    def test_copying_units_and_players(self):
+        self._prepare_game()
+        for game in (copy.deepcopy(self.game),
+                     pickle.loads(pickle.dumps(self.game, 2))):
+            player = game.players_by_IDs[self.player.ID]
+            base = game.units_by_IDs[self.base.ID]
+            self.assertFalse(base is self.base)
+            self.assertTrue(base.player is player)
+            self.assertTrue(player.maybe_base is base)
+            self.assertTrue(base in player.units)
+            self.assertEqual(base.minerals, self.base.minerals)
+            self.assertEqual(base.position, self.base.position)
+            self.assertTrue(game.game_map[base.position].maybe_object is base)
+
+    def test_fork(self):
+        self._prepare_game()
+        self.game._generate_input_for(self.miner)
+        input_layer = self.game._input_layer
+        game = self.game.fork()
+        miner = game.units_by_IDs[self.miner.ID]
+        game.move_unit_at(miner, (miner.position[0]+1, miner.position[1]))
+
+        self.assertTrue(game.configuration is self.game.configuration)
+        self.assertTrue(miner.type is self.miner.type)
+        self.assertTrue(game._input_layer is input_layer)
+        self.assertNotEqual(miner.position, self.miner.position)
+        self.assertTrue(self.game.game_map[self.miner.position].maybe_object
+                        is self.miner)
+
+    def test_saving_game_doesnt_change_moves(self):
+        self._prepare_game(many_starting_points=True)
+        destinations = [(60, 60), (3, 60), (60, 3), (40, 45)]
+        for miner, destination in zip(self.miners, destinations):
+            miner.command = cmds.ComplexMoveCommand(destination=destination)
+        self.tank.command = cmds.ComplexMoveCommand(destination=(50, 30))
+        saved = self.game.fork()
+        not_saved = self.game.fork()
+
+        for turn in xrange(40):
+            for game in (saved, not_saved):
+                random.seed(turn)
+                game._execute_commands()
+                # block fields in front of units, so paths are repaired
+                for ID in sorted(game.units_by_IDs):
+                    unit = game.units_by_IDs[ID]
+                    dx, dy = direction.TO_RAY[unit.direction]
+                    obstacle = (unit.position[0] + 2*dx,
+                                unit.position[1] + 2*dy)
+                    if (turn % 3 == 0 and
+                        game.game_map.is_accessible(*obstacle)):
+                        game.game_map[obstacle].place_object(Tree())
+            saved = pickle.loads(pickle.dumps(saved, 2)).fork()
+            not_saved = not_saved.fork()
+
+            for ID, unit in not_saved.units_by_IDs.iteritems():
+                self.assertEqual(saved.units_by_IDs[ID].position,
+                                 unit.position)
+                self.assertEqual(saved.units_by_IDs[ID].action, unit.action)
+
+    def test_render_snapshot(self):
+        self._prepare_game()
+        self.miner.action = actions.GatherAction(self.minerals_position)
+        snapshot = RenderSnapshot(self.game)
+        self.game.move_unit_at(self.tank, (self.tank.position[0]+1,
+                                           self.tank.position[1]))
+        self.game.game_map[0, 0].change_ground(2)
+
+        i = snapshot.unit_IDs.index(self.miner.ID)
+        self.assertEqual(snapshot.unit_positions[i], self.miner.position)
+        self.assertEqual(snapshot.unit_type_names[i],
+                         self.miner.type.main_name)
+        self.assertEqual(snapshot.unit_actions[i], self.miner.action)
+        self.assertEqual(snapshot.players[snapshot.unit_player_IDs[i]],
+                         (self.player.name, self.player.color))
+        i = snapshot.unit_IDs.index(self.tank.ID)
+        self.assertNotEqual(snapshot.unit_positions[i], self.tank.position)
+        self.assertEqual(snapshot.ground_type_at(0, 0), 1)
+        self.assertEqual(snapshot.ground_type_at(-1, 0), 0)
+        tree = self.game.game_map[self.trees_position].maybe_object
+        self.assertEqual(snapshot.trees, [(self.trees_position, tree.type)])
+        self.assertEqual(snapshot.mineral_deposits,
+                         [(self.minerals_position, 20)])
+
+    def test_unpickling_unit_pickled_by_older_version(self):
+        self._prepare_game()
+        unit = Unit.__new__(Unit)
+        state = self.miner.__getstate__()
+        del state['outbox_queue']
+        unit.__setstate__(state)
+
+        self.assertEqual(unit.ID, self.miner.ID)
+        self.assertEqual(unit.outbox_queue, [])
+
+
 class TestUtils(BaseGameTestCase):
     def test_searching_nearest_unit(self):
         self._prepare_game(many_starting_points=True)
@@ -609,6 +705,53 @@ class TestExecuteActions(BaseGameTestCase):
           self.game.game_map[self.minerals_position].maybe_object.minerals)
 
 
+    def test_units_going_to_the_same_destination(self):
+        self._prepare_game()
+        destination = (30, 40)
+        for miner in self.miners:
+            miner.command = cmds.ComplexMoveCommand(destination=destination)
+        old_distances = [distance(miner.position, destination)
+                         for miner in self.miners]
+
+        self.game._execute_commands()
+
+        for miner, old_distance in zip(self.miners, old_distances):
+            self.assertTrue(isinstance(miner.action, actions.MoveAction))
+            self.assertEqual(distance(miner.position, destination),
+                             old_distance-1)
+        self.assertEqual(self.game._flow_fields_by_destinations, None)
+
+    def test_going_to_walled_off_destination(self):
+        self._prepare_game()
+        destination = (30, 40)
+        for dx, dy in direction.FROM_RAY:
+            tree_position = (destination[0] + dx, destination[1] + dy)
+            self.game.game_map[tree_position].place_object(Tree())
+        self.miner.command = cmds.ComplexMoveCommand(destination=destination)
+
+        self.game._execute_commands()
+        self.assertTrue(isinstance(self.miner.action, actions.StopAction))
+
+        self.game.fire_at(tree_position)
+        self.game._execute_commands()
+        self.assertTrue(isinstance(self.miner.action, actions.MoveAction))
+
+    def test_unit_blocking_best_step_of_flow_field(self):
+        self._prepare_game()
+        destination = (40, 30)
+        first = self.game.new_unit(self.player, (30, 31), self.miner_type)
+        second = self.game.new_unit(self.player, (30, 30), self.miner_type)
+        self.game._flow_fields_by_destinations = \
+            {destination : FlowField(self.game.game_map, destination)}
+        self.game._find_direction(first.position, destination, first.ID)
+        self.game.new_unit(self.player, (31, 30), self.miner_type)
+
+        step = self.game._find_direction(second.position, destination,
+                                         second.ID)
+
+        self.assertTrue(step in (direction.N, direction.S))
+
+
 class TestMessageSystem(BaseGameTestCase):
     def test_send_message_between_players_allowed(self):
         self._prepare_game(many_starting_points=True)
@@ -798,6 +941,82 @@ print "MOVE 15 15"
         finally:
             self.file_system.delete_files_and_folders()
 
+    def test_tic_with_many_workers(self):
+        class EchoProgram(object):
+            reentrant = True
+            def __call__(self, language, program_code, input_data):
+                running_status = ('%s\n%s' % (program_code, input_data),
+                                  '', False, 0.001)
+                return None, running_status
+
+        for miner in self.miners:
+            program = Program(Language.PYTHON, 'miner %d' % miner.ID)
+            self.game.set_program(miner, program)
+
+        self.game.tic(EchoProgram(), max_workers=4)
+
+        for miner in self.miners:
+            run_status = miner.maybe_run_status
+            self.assertEqual(run_status.output,
+                             'miner %d\n%s' % (miner.ID, run_status.input))
+            self.assertEqual(run_status.input.split()[1], str(miner.ID))
+
+    def test_tic_with_memoized_outputs(self):
+        deterministic_flags = []
+        def compile_and_run(language, program_code, input_data,
+                            deterministic=False):
+            deterministic_flags.append(deterministic)
+            return None, ('', '', False, 0.001)
+
+        self.game.set_program(self.miners[0], Program(Language.PYTHON, ''))
+        self.game.memoize_outputs = True
+        self.game.tic(compile_and_run)
+
+        self.assertEqual(deterministic_flags, [True])
+
+    def test_tic_without_run_inputs(self):
+        def compile_and_run(language, program_code, input_data):
+            return None, ('output', '', False, 0.001)
+
+        self.game.set_program(self.miners[0], Program(Language.PYTHON, ''))
+        self.game.keep_run_inputs = False
+        self.game.tic(compile_and_run)
+
+        run_status = self.miners[0].maybe_run_status
+        self.assertEqual(run_status.output, 'output')
+        self.assertEqual(run_status.input, None)
+
+    def test_tic_with_batch_program(self):
+        class BatchEchoProgram(object):
+            def __init__(self):
+                self.calls = 0
+            def supports_batch(self, language, program_code):
+                return True
+            def run_many(self, language, program_code, inputs):
+                self.calls += 1
+                return None, [(input_data, '', False, 0.001)
+                              for input_data in inputs]
+
+        for miner in self.miners:
+            self.game.set_program(miner, Program(Language.PYTHON, 'code'))
+        batch_echo_program = BatchEchoProgram()
+        self.game.tic(batch_echo_program)
+
+        self.assertEqual(batch_echo_program.calls, 1)
+        for miner in self.miners:
+            run_status = miner.maybe_run_status
+            self.assertEqual(run_status.output, run_status.input)
+
+        # the group of units is split between workers
+        batch_echo_program.reentrant = True
+        batch_echo_program.calls = 0
+        self.game.tic(batch_echo_program, max_workers=2)
+
+        self.assertEqual(batch_echo_program.calls, 2)
+        for miner in self.miners:
+            run_status = miner.maybe_run_status
+            self.assertEqual(run_status.output, run_status.input)
+
     def test_tic_for_world(self):
         assert self.game.configuration.probability_of_mineral_deposit_growing == 1.0
         old_minerals_amount = \
@@ -809,6 +1028,38 @@ print "MOVE 15 15"
           self.game.game_map[self.minerals_position].maybe_object.minerals
         self.assertEqual(new_minerals_amount, old_minerals_amount+1)
 
+    def test_cached_input_is_the_same_as_generated_from_scratch(self):
+        self.game._generate_input_for(self.tank)
+        x, y = self.tank.position
+        self.game.game_map[x+1, y-1].place_object(Tree())
+        self.game.move_unit_at(self.tank, (x, y-1))
+        self.game._generate_input_for(self.tank)
+        self.game.fire_at((x+1, y-1))
+
+        input = self.game._generate_input_for(self.tank)
+        fresh_game = copy.deepcopy(self.game)
+        fresh_game._input_layer = None
+        fresh_tank = fresh_game.units_by_IDs[self.tank.ID]
+        self.assertEqual(fresh_game._generate_input_for(fresh_tank), input)
+
+    def test_input_layer_is_updated_after_changes(self):
+        self.game._generate_input_for(self.tank)
+        self.game._tic_for_world()
+        self.game.move_unit_at(self.tank, (self.tank.position[0]+1,
+                                           self.tank.position[1]))
+        self.game._generate_input_for(self.tank)
+
+        x, y = self.minerals_position
+        minerals = \
+          self.game.game_map[self.minerals_position].maybe_object.minerals
+        self.assertEqual(self.game._input_layer.view(x, y, x, y),
+                         '2 %d 0' % minerals)
+        x, y = self.tank.position
+        self.assertEqual(self.game._input_layer.view(x-1, y, x, y),
+                         '0 0 0 %s %d %d' % (self.tank.type.main_name,
+                                             self.tank.ID,
+                                             self.player.ID))
+
 
 class TestGameConfiguration(unittest.TestCase):
     def setUp(self):